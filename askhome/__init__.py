@@ -4,5 +4,7 @@ import logging
 logger = logging.getLogger('askhome')
 
 from .appliance import Appliance
+from .cache import DiscoveryCache, ResponseCache, StateCache
+from .pool import AppliancePool
 from .smarthome import Smarthome
 from .requests import create_request
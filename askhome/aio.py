@@ -0,0 +1,98 @@
+"""Asyncio support for ``Smarthome``. Requires Python 3.5+, the module is not imported on older
+versions.
+"""
+import asyncio
+import inspect
+
+from .exceptions import AskhomeException
+from .utils import HandlerCall
+
+
+class AsyncSmarthomeMixin(object):
+    """Coroutine counterpart of ``Smarthome.lambda_handler``, mixed into ``Smarthome``."""
+
+    async def async_lambda_handler(self, data, context=None):
+        """Asynchronous entry point for handling requests.
+
+        Works the same as ``lambda_handler``, except that action methods and handlers (prepare,
+        discover, get appliance and health check) can be coroutine functions, which are awaited.
+        Regular functions are still called directly.
+        """
+        log_payloads = self._should_log_payloads()
+        if log_payloads:
+            self._log_payload(data)
+
+        response = await self._async_lambda_handler(data, context)
+        if log_payloads:
+            self._log_payload(response)
+
+        return response
+
+    async def async_handle_bytes(self, raw, context=None):
+        """Asynchronous counterpart of ``handle_bytes``, see ``async_lambda_handler``. Useful
+        for serving events from handlers of asyncio web frameworks.
+        """
+        response = await self.async_lambda_handler(self.decode_event(raw), context)
+        return self.encode_response(response)
+
+    async def _async_lambda_handler(self, data, context=None):
+        if self.response_cache is not None:
+            return await self._async_deduplicate(data, context)
+        return await self._async_handle_event(data, context)
+
+    async def _async_deduplicate(self, data, context):
+        cache = self.response_cache
+        key = cache.key(data)
+        response, in_flight = cache.acquire(key)
+        if response is not None:
+            return response
+        if in_flight is not None:
+            loop = asyncio.get_event_loop()
+            response = await loop.run_in_executor(None, cache.wait, in_flight)
+            if response is None:
+                response = await self._async_handle_event(data, context)
+            return response
+
+        try:
+            response = await self._async_handle_event(data, context)
+        finally:
+            cache.release(key, response)
+        return response
+
+    async def _async_handle_event(self, data, context=None):
+        request, stopwatch = self._create_request(data, context)
+
+        routing = self._route(request, stopwatch)
+        try:
+            call = next(routing)
+            while isinstance(call, HandlerCall):
+                try:
+                    if call.timeout is None:
+                        result = call.func(*call.args)
+                        if inspect.isawaitable(result):
+                            result = await result
+                    else:
+                        result = await self._async_call_with_timeout(call)
+                except AskhomeException as exception:
+                    call = routing.throw(exception)
+                else:
+                    call = routing.send(result)
+        finally:
+            # Also lets routing clean up when a handler raises an unexpected exception
+            routing.close()
+        return call
+
+    async def _async_call_with_timeout(self, call):
+        if call.timeout <= 0:
+            raise self.deadline_exception()
+
+        if inspect.iscoroutinefunction(call.func):
+            awaitable = call.func(*call.args)
+        else:
+            awaitable = asyncio.get_event_loop().run_in_executor(None, call.run)
+        try:
+            return await asyncio.wait_for(awaitable, call.timeout)
+        except asyncio.TimeoutError:
+            # Cancelled coroutines are finished, functions in the executor keep running
+            call.abandon()
+            raise self.deadline_exception()
@@ -1,4 +1,4 @@
-from .utils import get_action_string, get_request_string
+from .utils import get_action_string, get_request_string, with_metaclass, FrozenDict
 
 
 class _classproperty(property):
@@ -14,7 +14,45 @@ class _classproperty(property):
         return self.func(owner)
 
 
-class Appliance(object):
+class _ApplianceMeta(type):
+    """Metaclass that precompiles the action tables of ``Appliance`` subclasses.
+
+    Tables are built once when the class is created, so routing a request is a plain dict lookup.
+    They are rebuilt for the class and all of its subclasses whenever an attribute is set on or
+    deleted from the class later, which keeps methods added after class creation working.
+    """
+    def __init__(cls, name, bases, namespace):
+        super(_ApplianceMeta, cls).__init__(name, bases, namespace)
+        cls._build_tables()
+
+    def __setattr__(cls, name, value):
+        super(_ApplianceMeta, cls).__setattr__(name, value)
+        cls._rebuild_tables()
+
+    def __delattr__(cls, name):
+        super(_ApplianceMeta, cls).__delattr__(name)
+        cls._rebuild_tables()
+
+    def _build_tables(cls):
+        actions = {}
+        request_handlers = {}
+        for supercls in cls.__mro__:  # This makes inherited Appliances work
+            for method in supercls.__dict__.values():
+                for action in getattr(method, 'ask_actions', []):
+                    actions[get_action_string(action)] = method
+                    request_handlers[get_request_string(action)] = method
+
+        # Bypass __setattr__ so that storing the tables doesn't trigger another rebuild
+        type.__setattr__(cls, '_actions', FrozenDict(actions))
+        type.__setattr__(cls, '_request_handlers', FrozenDict(request_handlers))
+
+    def _rebuild_tables(cls):
+        cls._build_tables()
+        for subcls in cls.__subclasses__():
+            subcls._rebuild_tables()
+
+
+class Appliance(with_metaclass(_ApplianceMeta)):
     """Appliance subclasses are used to describe what actions devices support.
 
     Methods of subclasses can be marked with decorators (like ``@Appliance.action``) and are used to
@@ -29,17 +67,38 @@ class Appliance(object):
         id (str): Identifier of the appliance from the appliance.applianceId of request payload.
         additional_details (dict): Information that was sent for the DiscoverAppliancesRequest.
             Some instance specific details can be saved here.
+        rate_limit (RateLimit): Class attribute limiting requests to each appliance of the class
+            separately. Can be overridden per appliance in ``Smarthome.add_appliance``.
+        class_rate_limit (RateLimit): Class attribute limiting requests to all appliances of the
+            class together, for example to protect a shared device cloud.
+        circuit_breaker (CircuitBreaker): Class attribute failing requests to appliances of the
+            class fast while their backend is down.
 
     """
+    rate_limit = None
+    class_rate_limit = None
+    circuit_breaker = None
 
     def __init__(self, request=None):
         """Appliance gets initialized just before its action methods are called. Put your
         logic for preparation before handling the request here.
         """
         if request is not None:
-            self.request = request
-            self.id = request.appliance_id
-            self.additional_details = request.appliance_details
+            self.bind(request)
+
+    def bind(self, request):
+        """Set the currently processed request. Called from ``__init__`` and for every following
+        request when the instance is reused by ``AppliancePool``. Override it to refresh request
+        specific state, but don't forget to call the parent method.
+        """
+        self.request = request
+        self.id = request.appliance_id
+        self.additional_details = request.appliance_details
+
+    def teardown(self):
+        """Called when an instance reused by ``AppliancePool`` is evicted or discarded. Close
+        sessions and release other resources opened in ``__init__`` here.
+        """
 
     @classmethod
     def action(cls, func):
@@ -85,28 +144,18 @@ class Appliance(object):
     def actions(cls):
         """dict(str, function): All actions the appliance supports and their corresponding (unbound)
         method references. Action names are formatted for the DiscoverAppliancesRequest.
+        The table is read-only and precomputed when the class is created.
         """
-        ret = {}
-        for supercls in cls.__mro__:  # This makes inherited Appliances work
-            for method in supercls.__dict__.values():
-                for action in getattr(method, 'ask_actions', []):
-                    ret[get_action_string(action)] = method
-
-        return ret
+        return cls._actions
 
     @_classproperty
     def request_handlers(cls):
         """dict(str, function): All requests the appliance supports (methods marked as actions)
         and their corresponding (unbound) method references. For example action turn_on would be
-        formatted as TurnOnRequest.
+        formatted as TurnOnRequest. The table is read-only and precomputed when the class is
+        created.
         """
-        ret = {}
-        for supercls in cls.__mro__:  # This makes inherited Appliances work
-            for method in supercls.__dict__.values():
-                for action in getattr(method, 'ask_actions', []):
-                    ret[get_request_string(action)] = method
-
-        return ret
+        return cls._request_handlers
 
     class Details:
         """Inner class in ``Appliance`` subclasses provides default values so that they don't
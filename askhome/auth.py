@@ -0,0 +1,118 @@
+import time
+
+from .cache import TTLCache
+from .exceptions import ExpiredAccessTokenError, InvalidAccessTokenError
+from .utils import call_blocking, monotonic
+
+
+class TokenValidator(object):
+    """Validates access tokens of requests and caches the results, see
+    ``Smarthome.token_validator``.
+
+    The validator function takes the access token and returns information about it, usually the
+    token introspection response of the identity service (RFC 7662). Falsy results and dicts with
+    false ``active`` mean an invalid token, dicts with ``exp`` (Unix time) in the past an expired
+    one. The function can also raise ``InvalidAccessTokenError`` or ``ExpiredAccessTokenError``
+    itself, other exceptions are not cached. It can be a coroutine function when used with
+    ``Smarthome.async_lambda_handler``.
+
+    Valid results are cached for ``ttl`` seconds, but never past the ``exp`` of the token. Invalid
+    and expired tokens are cached for ``negative_ttl`` seconds.
+    """
+    def __init__(self, func, ttl=300, negative_ttl=60, max_size=4096, clock=monotonic,
+                 time_func=time.time):
+        """
+        Args:
+            func (callable): Validator function taking the access token.
+            ttl (float): Seconds valid tokens are cached for.
+            negative_ttl (float): Seconds invalid and expired tokens are cached for.
+            max_size (int): Maximum number of cached tokens, least recently used are evicted.
+            clock (callable): Function returning current time in seconds.
+            time_func (callable): Function returning current Unix time, compared with ``exp``.
+        """
+        self.func = func
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.time_func = time_func
+        # Token -> (token info, None) or (None, exception class)
+        self._results = TTLCache(max_size, ttl, clock=clock)
+
+    @property
+    def hits(self):
+        """int: Number of tokens found in the cache."""
+        return self._results.hits
+
+    @property
+    def misses(self):
+        """int: Number of tokens passed to the validator function."""
+        return self._results.misses
+
+    def get(self, token):
+        """Return cached information about valid token, None if the token isn't cached.
+
+        Raises:
+            InvalidAccessTokenError: If the token is missing or cached as invalid.
+            ExpiredAccessTokenError: If the token is cached as expired.
+
+        """
+        if token is None:
+            raise InvalidAccessTokenError
+        result = self._results.get(token)
+        if result is None:
+            return None
+        info, error = result
+        if error is not None:
+            raise error()
+        return info
+
+    def set(self, token, info):
+        """Cache result of the validator function and return it if the token is valid.
+
+        Raises:
+            InvalidAccessTokenError: If the result means the token isn't valid.
+            ExpiredAccessTokenError: If the token has expired.
+
+        """
+        ttl = self.ttl
+        if not info or isinstance(info, dict) and not info.get('active', True):
+            self.set_error(token, InvalidAccessTokenError)
+        if isinstance(info, dict) and info.get('exp') is not None:
+            expires_in = info['exp'] - self.time_func()
+            if expires_in <= 0:
+                self.set_error(token, ExpiredAccessTokenError)
+            ttl = min(ttl, expires_in)
+
+        self._results.set(token, (info, None), ttl)
+        return info
+
+    def set_error(self, token, exception):
+        """Cache the token as invalid or expired and raise the exception.
+
+        Args:
+            exception (type|Exception): ``InvalidAccessTokenError`` or ``ExpiredAccessTokenError``.
+
+        """
+        if not isinstance(exception, type):
+            exception = type(exception)
+        self._results.set(token, (None, exception), self.negative_ttl)
+        raise exception()
+
+    def validate(self, token):
+        """Return information about valid token, calling the validator function if it isn't
+        cached. Useful for validating tokens outside of ``Smarthome``, e.g. in a prepare handler.
+        """
+        info = self.get(token)
+        if info is not None:
+            return info
+        try:
+            info = call_blocking(self.func, token)
+        except (InvalidAccessTokenError, ExpiredAccessTokenError) as exception:
+            self.set_error(token, exception)
+        return self.set(token, info)
+
+    def invalidate(self, token=None):
+        """Remove cached result of the token, all if None."""
+        if token is None:
+            self._results.clear()
+        else:
+            self._results.pop(token)
@@ -0,0 +1,281 @@
+"""Benchmarks of askhome's own overhead, runnable without network access::
+
+    $ python -m askhome.benchmark
+    $ python -m askhome.benchmark --save baseline.json
+    $ python -m askhome.benchmark --compare baseline.json
+
+Every scenario drives ``Smarthome.lambda_handler`` with a synthetic event and reports throughput,
+median and 99th percentile latency and memory allocated per call that's still alive afterwards
+(mostly the response). Comparing with a saved baseline exits with status 1 when the throughput of
+any scenario drops by more than the threshold.
+
+Allocation measurements need ``tracemalloc`` (Python 3.4+).
+"""
+from __future__ import print_function
+
+import argparse
+import gc
+import json
+import sys
+from datetime import datetime
+from timeit import default_timer
+
+from .appliance import Appliance
+from .exceptions import TargetOfflineError
+from .requests import create_request
+from .smarthome import Smarthome
+
+MESSAGE_ID = '01ebf625-0b89-4c4d-b3aa-32340e894688'
+
+
+def make_event(name, namespace='Alexa.ConnectedHome.Control', appliance_id='light1', **payload):
+    """Create synthetic Alexa event, keyword arguments are added to the payload."""
+    payload['accessToken'] = '[OAuth token here]'
+    if appliance_id is not None:
+        payload['appliance'] = {
+            'additionalApplianceDetails': {'type': 'Light'},
+            'applianceId': appliance_id
+        }
+    return {
+        'header': {
+            'messageId': MESSAGE_ID,
+            'name': name,
+            'namespace': namespace,
+            'payloadVersion': '2'
+        },
+        'payload': payload
+    }
+
+
+def control_event(name='SetPercentageRequest', appliance_id='light1'):
+    """Create synthetic Alexa control event."""
+    return make_event(name, appliance_id=appliance_id, percentageState={'value': 42.0})
+
+
+class BenchAppliance(Appliance):
+    """Appliance supporting every action without doing any work."""
+    @Appliance.action_for('turn_on', 'turn_off', 'set_percentage', 'increment_percentage',
+                          'decrement_percentage')
+    def control(self, request):
+        pass
+
+    @Appliance.action_for('set_target_temperature', 'increment_target_temperature',
+                          'decrement_target_temperature')
+    def change_temperature(self, request):
+        return request.response(21.5, mode='HEAT', previous_temperature=20.5)
+
+    @Appliance.action
+    def get_target_temperature(self, request):
+        return request.response(21.5, timestamp=datetime(2017, 6, 2, 12, 0))
+
+    @Appliance.action
+    def get_temperature_reading(self, request):
+        return request.response(20.5, timestamp=datetime(2017, 6, 2, 12, 0))
+
+    @Appliance.action_for('set_lock_state', 'get_lock_state')
+    def lock_state(self, request):
+        return request.response('LOCKED')
+
+
+class OfflineAppliance(Appliance):
+    """Appliance whose actions always fail."""
+    @Appliance.action
+    def turn_on(self, request):
+        raise TargetOfflineError
+
+
+def make_smarthome(appliances=100):
+    """Create ``Smarthome`` with given number of benchmark appliances."""
+    home = Smarthome(manufacturer='Benchmark Corp')
+    for i in range(appliances):
+        home.add_appliance('light%d' % (i + 1), BenchAppliance, name='Light %d' % (i + 1))
+    home.add_appliance('offline', OfflineAppliance, name='Offline Light')
+    return home
+
+
+def scenarios(appliances=100):
+    """Return list of (name, function without arguments) benchmark scenarios."""
+    home = make_smarthome(appliances)
+    query = 'Alexa.ConnectedHome.Query'
+    events = [
+        ('discover (%d appliances)' % appliances,
+         make_event('DiscoverAppliancesRequest', 'Alexa.ConnectedHome.Discovery', None)),
+        ('health check',
+         make_event('HealthCheckRequest', 'Alexa.ConnectedHome.System', None,
+                    initiationTimestamp='1435302567000')),
+        ('turn on', make_event('TurnOnRequest')),
+        ('set percentage', control_event()),
+        ('increment percentage',
+         make_event('IncrementPercentageRequest', deltaPercentage={'value': 10.0})),
+        ('set target temperature',
+         make_event('SetTargetTemperatureRequest', targetTemperature={'value': 21.5})),
+        ('decrement target temperature',
+         make_event('DecrementTargetTemperatureRequest', deltaTemperature={'value': 1.0})),
+        ('set lock state', make_event('SetLockStateRequest', lockState='LOCKED')),
+        ('get target temperature', make_event('GetTargetTemperatureRequest', query)),
+        ('get temperature reading', make_event('GetTemperatureReadingRequest', query)),
+        ('get lock state', make_event('GetLockStateRequest', query)),
+        ('error: unsupported target', make_event('TurnOnRequest', appliance_id='missing')),
+        ('error: unsupported operation', make_event('SetColorRequest')),
+        ('error: target offline', make_event('TurnOnRequest', appliance_id='offline')),
+    ]
+
+    ret = [('parse request', lambda event=control_event(): create_request(event))]
+    for name, event in events:
+        ret.append((name, lambda event=event: home.lambda_handler(event)))
+    return ret
+
+
+def measure_allocations(func, number=1000):
+    """Measure memory allocated by a function and still alive after it returns.
+
+    Args:
+        func (callable): Function without arguments, its results are kept alive during the
+            measurement.
+        number (int): Number of calls.
+
+    Returns:
+        (float, float): Average count of allocated blocks and bytes per call.
+
+    """
+    import tracemalloc
+
+    results = []
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        for _ in range(number):
+            results.append(func())
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+
+    stats = after.compare_to(before, 'filename')
+    count = sum(stat.count_diff for stat in stats)
+    size = sum(stat.size_diff for stat in stats)
+    # Don't count the list holding the results
+    count -= 1
+    size -= sys.getsizeof(results)
+    return float(count) / number, float(size) / number
+
+
+def measure_latency(func, number=10000):
+    """Measure throughput and latency distribution of a function.
+
+    Returns:
+        dict: Operations per second and median and 99th percentile latency in microseconds.
+
+    """
+    # Warm up caches before measuring
+    for _ in range(min(number, 100)):
+        func()
+
+    timings = []
+    timer = default_timer
+    start = timer()
+    for _ in range(number):
+        call_start = timer()
+        func()
+        timings.append(timer() - call_start)
+    total = timer() - start
+
+    timings.sort()
+    return {
+        'ops': number / total,
+        'p50': timings[len(timings) // 2] * 1e6,
+        'p99': timings[min(len(timings) - 1, int(len(timings) * 0.99))] * 1e6,
+    }
+
+
+def run(number=10000, appliances=100, name_filter=None):
+    """Run all benchmark scenarios.
+
+    Args:
+        number (int): Number of calls in every scenario.
+        appliances (int): Number of appliances registered in the ``Smarthome``.
+        name_filter (str): Run only scenarios containing this string.
+
+    Returns:
+        dict(str, dict): Results of every scenario, see ``measure_latency``. Allocated blocks and
+        bytes are added as ``allocs`` and ``bytes`` when ``tracemalloc`` is available.
+
+    """
+    results = {}
+    for name, func in scenarios(appliances):
+        if name_filter is not None and name_filter not in name:
+            continue
+        result = measure_latency(func, number)
+        try:
+            result['allocs'], result['bytes'] = measure_allocations(func, min(number, 1000))
+        except ImportError:
+            pass
+        results[name] = result
+    return results
+
+
+def compare(results, baseline, threshold=0.1):
+    """Compare results with baseline results.
+
+    Returns:
+        list(str): Names of scenarios whose throughput dropped more than threshold (fraction).
+
+    """
+    regressions = []
+    for name, result in results.items():
+        if name in baseline and result['ops'] < baseline[name]['ops'] * (1 - threshold):
+            regressions.append(name)
+    return regressions
+
+
+def format_results(results, baseline=None):
+    lines = ['%-36s %12s %10s %10s %8s %8s' % ('scenario', 'ops/sec', 'p50 us', 'p99 us',
+                                              'allocs', 'bytes')]
+    for name in sorted(results):
+        result = results[name]
+        line = '%-36s %12.0f %10.2f %10.2f %8s %8s' % (
+            name, result['ops'], result['p50'], result['p99'],
+            '%.1f' % result['allocs'] if 'allocs' in result else '-',
+            '%.0f' % result['bytes'] if 'bytes' in result else '-')
+        if baseline is not None and name in baseline:
+            line += ' %+7.1f%%' % ((result['ops'] / baseline[name]['ops'] - 1) * 100)
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark askhome's request routing.")
+    parser.add_argument('-n', '--number', type=int, default=10000,
+                        help='calls per scenario (default: %(default)s)')
+    parser.add_argument('-a', '--appliances', type=int, default=100,
+                        help='appliances registered for discovery (default: %(default)s)')
+    parser.add_argument('-k', '--filter', help='run only scenarios containing this string')
+    parser.add_argument('--save', metavar='FILE', help='save results as JSON baseline')
+    parser.add_argument('--compare', metavar='FILE', help='compare results with saved baseline')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='allowed throughput drop against baseline (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    results = run(args.number, args.appliances, args.filter)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    print(format_results(results, baseline))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('\nRegressions: %s' % ', '.join(sorted(regressions)))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
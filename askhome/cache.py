@@ -0,0 +1,398 @@
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+from .utils import monotonic, call_blocking
+from . import logger
+
+
+class TTLCache(object):
+    """Thread-safe mapping with limited size and optional time to live of entries.
+
+    When full, the least recently used entry is evicted. Expired entries are evicted lazily, when
+    they're accessed or pushed out by new entries.
+
+    Attributes:
+        max_size (int): Maximum number of entries.
+        ttl (float): Default time to live of entries in seconds, None for no expiration.
+        on_evict (callable): Called with key and value of every entry that's evicted, expired,
+            replaced or removed.
+        hits (int): Number of successful ``get`` calls.
+        misses (int): Number of ``get`` calls that didn't find a live entry.
+
+    """
+    def __init__(self, max_size=128, ttl=None, on_evict=None, clock=monotonic):
+        """
+        Args:
+            max_size (int): Maximum number of entries.
+            ttl (float): Default time to live of entries in seconds, None for no expiration.
+            on_evict (callable): Called with key and value of every entry leaving the cache.
+            clock (callable): Function returning current time in seconds.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (value, expiration time or None)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return live value for key and mark it as recently used, default if there's none."""
+        evicted = None
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None and entry[1] is not None and entry[1] <= self.clock():
+                evicted, entry = entry, None
+
+            if entry is None:
+                self.misses += 1
+                value = default
+            else:
+                self.hits += 1
+                self._data[key] = entry  # Reinsert to move the entry to the end
+                value = entry[0]
+
+        if evicted is not None:
+            self._evict(key, evicted[0])
+        return value
+
+    def take(self, key, default=None):
+        """Remove live value for key and return it without calling ``on_evict``, default if
+        there's none. Useful for handing values out exclusively and setting them back later.
+        """
+        evicted = None
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None and entry[1] is not None and entry[1] <= self.clock():
+                evicted, entry = entry, None
+
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        if evicted is not None:
+            self._evict(key, evicted[0])
+        return default if entry is None else entry[0]
+
+    def set(self, key, value, ttl=None):
+        """Store value under key.
+
+        Args:
+            key (hashable): Key of the entry.
+            value (Any): Stored value.
+            ttl (float): Time to live of this entry in seconds, ``ttl`` of the cache if None.
+
+        """
+        if ttl is None:
+            ttl = self.ttl
+        expires = None if ttl is None else self.clock() + ttl
+
+        evicted = []
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None and old[0] is not value:
+                evicted.append((key, old[0]))
+            self._data[key] = (value, expires)
+            while len(self._data) > self.max_size:
+                old_key, old = self._data.popitem(last=False)
+                evicted.append((old_key, old[0]))
+
+        for evicted_key, evicted_value in evicted:
+            self._evict(evicted_key, evicted_value)
+
+    def pop(self, key, default=None):
+        """Remove entry and return its value (even if expired), default if there's none."""
+        with self._lock:
+            entry = self._data.pop(key, None)
+        if entry is None:
+            return default
+        self._evict(key, entry[0])
+        return entry[0]
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            entries = list(self._data.items())
+            self._data.clear()
+        for key, entry in entries:
+            self._evict(key, entry[0])
+
+    def __len__(self):
+        return len(self._data)
+
+    def _evict(self, key, value):
+        if self.on_evict is not None:
+            self.on_evict(key, value)
+
+
+class DiscoveryCache(object):
+    """Caches responses of ``Smarthome.discover_handler`` per user.
+
+    Set an instance to ``Smarthome.discovery_cache`` to enable it. Repeated discoveries from the
+    same user within ``ttl`` are answered from memory without calling the handler. After that,
+    the entry is stale for another ``stale_ttl`` seconds: it's still returned, but the handler is
+    called in a background thread to refresh it (stale-while-revalidate).
+    """
+    def __init__(self, ttl=300, stale_ttl=0, max_size=1024, key_func=None, clock=monotonic):
+        """
+        Args:
+            ttl (float): Seconds the cached discovery is fresh.
+            stale_ttl (float): Seconds the stale discovery is still served while being refreshed.
+            max_size (int): Maximum number of cached users, least recently used are evicted.
+            key_func (callable): Function returning cache key for a ``Request``, the access token
+                by default.
+            clock (callable): Function returning current time in seconds.
+        """
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.key_func = key_func
+        self.clock = clock
+        # Key -> (payload, time until which the payload is fresh)
+        self._entries = TTLCache(max_size, ttl + stale_ttl, clock=clock)
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    @property
+    def hits(self):
+        """int: Number of discoveries answered from the cache."""
+        return self._entries.hits
+
+    @property
+    def misses(self):
+        """int: Number of discoveries that called the handler."""
+        return self._entries.misses
+
+    def key(self, request):
+        """Return cache key of the request."""
+        if self.key_func is None:
+            return request.access_token
+        return self.key_func(request)
+
+    def get(self, key):
+        """Return ``(payload, stale)`` of cached discovery, ``(None, False)`` if there's none."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None, False
+        payload, fresh_until = entry
+        return payload, fresh_until <= self.clock()
+
+    def set(self, key, response):
+        """Cache payload of a DiscoverAppliancesResponse, other responses (and anything else the
+        discover handler returned) are ignored.
+        """
+        if (not isinstance(response, dict) or
+                response.get('header', {}).get('name') != 'DiscoverAppliancesResponse'):
+            return
+        self._entries.set(key, (response['payload'], self.clock() + self.ttl))
+
+    def refresh(self, key, func, request):
+        """Call discover handler in a background thread and cache its response, unless a refresh
+        for the key is already running.
+        """
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        thread = threading.Thread(target=self._refresh, args=(key, func, request))
+        thread.daemon = True
+        thread.start()
+
+    def invalidate(self, key=None):
+        """Remove cached discovery of the key (as returned by ``key``), all if None."""
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key)
+
+    def _refresh(self, key, func, request):
+        try:
+            self.set(key, call_blocking(func, request))
+        except Exception:
+            logger.exception('Refreshing cached discovery failed')
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+
+class StateCache(object):
+    """Last known states of appliances, for answering query requests without asking the device.
+
+    Set an instance to ``Smarthome.state_cache`` to enable it. States are stored per appliance
+    and query request name as response payloads. Responses of query requests are recorded
+    automatically, as well as states set by control requests (``SetTargetTemperatureRequest`` and
+    friends for ``GetTargetTemperatureRequest``, ``SetLockStateRequest`` for
+    ``GetLockStateRequest``). Actions read them with ``Request.cached_response``.
+    """
+    def __init__(self, max_size=4096, ttl=None, clock=monotonic):
+        """
+        Args:
+            max_size (int): Maximum number of cached states, least recently used are evicted.
+            ttl (float): Seconds after which states are dropped, None to keep them until evicted.
+            clock (callable): Function returning current time in seconds.
+        """
+        self.clock = clock
+        # (appliance id, query name) -> (payload, timestamp, time of recording)
+        self._entries = TTLCache(max_size, ttl, clock=clock)
+        self._names = set()
+
+    @property
+    def hits(self):
+        """int: Number of states found in the cache."""
+        return self._entries.hits
+
+    @property
+    def misses(self):
+        """int: Number of states not found in the cache."""
+        return self._entries.misses
+
+    def get(self, appliance_id, name, max_age=None):
+        """Return ``(payload, timestamp)`` of cached state, None if there's none.
+
+        Args:
+            appliance_id (str): Identifier of the appliance.
+            name (str): Name of the query request, e.g. ``'GetLockStateRequest'``.
+            max_age (float): Ignore state recorded more than this many seconds ago.
+
+        """
+        entry = self._entries.get((appliance_id, name))
+        if entry is None:
+            return None
+        payload, timestamp, recorded = entry
+        if max_age is not None and self.clock() - recorded > max_age:
+            return None
+        return payload, timestamp
+
+    def set(self, appliance_id, name, payload, timestamp=None):
+        """Record state of an appliance, for example when the device reports a change.
+
+        Args:
+            appliance_id (str): Identifier of the appliance.
+            name (str): Name of the query request answered by the state.
+            payload (dict): Response payload without ``applianceResponseTimestamp``.
+            timestamp (datetime|str): Time the state was retrieved, current UTC time if None.
+
+        """
+        if timestamp is None:
+            timestamp = datetime.utcnow()
+        self._names.add(name)
+        self._entries.set((appliance_id, name), (payload, timestamp, self.clock()))
+
+    def invalidate(self, appliance_id=None, name=None):
+        """Remove cached states of the appliance (only of the query name if passed), all if
+        appliance_id is None.
+        """
+        if appliance_id is None:
+            self._entries.clear()
+            return
+        for state_name in list(self._names) if name is None else [name]:
+            self._entries.pop((appliance_id, state_name))
+
+
+class _InFlight(object):
+    """Request being handled by the first of its copies, duplicates wait for its response."""
+    __slots__ = ('event', 'response')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.response = None
+
+
+class ResponseCache(object):
+    """Caches responses by ``messageId`` and name of the request, so redelivered events don't
+    reach the appliances again.
+
+    Set an instance to ``Smarthome.response_cache`` to enable it. A duplicate of an event handled
+    within ``ttl`` seconds gets the stored response. A duplicate arriving while the first copy is
+    still being handled waits for its response, for at most ``wait_timeout`` seconds. If the
+    first copy fails with an unhandled exception or the wait times out, the duplicate is handled
+    as usual. Events without ``messageId`` aren't cached.
+
+    Error responses (e.g. ``TargetOfflineError``) are only passed to duplicates waiting for them
+    and not stored, so a redelivered event gets another chance once the error goes away.
+    """
+    def __init__(self, ttl=300, max_size=4096, wait_timeout=30, cache_errors=False,
+                 clock=monotonic):
+        """
+        Args:
+            ttl (float): Seconds responses are kept.
+            max_size (int): Maximum number of cached responses, least recently used are evicted.
+            wait_timeout (float): Seconds duplicates wait for the first copy, None for no limit.
+            cache_errors (bool): Store error responses too.
+            clock (callable): Function returning current time in seconds.
+        """
+        self.wait_timeout = wait_timeout
+        self.cache_errors = cache_errors
+        self._responses = TTLCache(max_size, ttl, clock=clock)
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    @property
+    def hits(self):
+        """int: Number of duplicates answered from the cache."""
+        return self._responses.hits
+
+    @property
+    def misses(self):
+        """int: Number of events not found in the cache."""
+        return self._responses.misses
+
+    @staticmethod
+    def key(data):
+        """Return cache key of raw event data, None if it has no ``messageId``."""
+        header = data['header']
+        message_id = header.get('messageId')
+        if message_id is None:
+            return None
+        return message_id, header['name']
+
+    def acquire(self, key):
+        """Look up response of the event with the key.
+
+        Returns:
+            (dict, object): Cached response and None if there is one. Otherwise None and an
+            in-flight token to ``wait`` for if another copy is being handled. None and None if the
+            caller should handle the event and ``release`` the key afterwards.
+
+        """
+        if key is None:
+            return None, None
+        with self._lock:
+            response = self._responses.get(key)
+            if response is not None:
+                return response, None
+            in_flight = self._in_flight.get(key)
+            if in_flight is None:
+                self._in_flight[key] = _InFlight()
+            return None, in_flight
+
+    def wait(self, in_flight):
+        """Wait for the copy being handled, return its response or None if it failed."""
+        in_flight.event.wait(self.wait_timeout)
+        return in_flight.response
+
+    def release(self, key, response=None):
+        """Store response of the event acquired by ``acquire`` and wake up its duplicates.
+        Pass None response if handling failed.
+        """
+        if key is None:
+            return
+        with self._lock:
+            in_flight = self._in_flight.pop(key, None)
+            if response is not None and (self.cache_errors or not _is_error(response)):
+                self._responses.set(key, response)
+        if in_flight is not None:
+            in_flight.response = response
+            in_flight.event.set()
+
+    def clear(self):
+        """Remove all cached responses."""
+        self._responses.clear()
+
+
+def _is_error(response):
+    # Names of all Alexa error responses end with Error
+    return response['header'].get('name', '').endswith('Error')
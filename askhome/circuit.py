@@ -0,0 +1,121 @@
+import threading
+
+from .exceptions import TargetOfflineError, DependentServiceUnavailableError
+from .utils import monotonic
+from . import logger
+
+
+class CircuitBreaker(object):
+    """Fails requests fast while the backend of an appliance is down, see
+    ``Appliance.circuit_breaker``.
+
+    The circuit opens after ``failure_threshold`` consecutive failures, i.e. actions raising one
+    of the ``exceptions``. While it's open, requests are answered right away with the error that
+    opened it, without creating the appliance. After ``recovery_timeout`` seconds the circuit is
+    half-open and lets a single probe request through: the circuit closes if it succeeds and opens
+    again if it fails. Share one instance between appliance classes using the same backend.
+
+    Attributes:
+        name (str): Name of the backend used in log messages, left out if None.
+
+    """
+    def __init__(self, failure_threshold=5, recovery_timeout=30,
+                 exceptions=(TargetOfflineError, DependentServiceUnavailableError), name=None,
+                 clock=monotonic):
+        """
+        Args:
+            failure_threshold (int): Number of consecutive failures opening the circuit.
+            recovery_timeout (float): Seconds after which the open circuit lets a probe through.
+            exceptions (tuple): ``AskhomeException`` subclasses counted as failures of the
+                backend. Other exceptions mean the backend responded and count as success.
+            name (str): Name of the backend used in log messages.
+            clock (callable): Function returning current time in seconds.
+        """
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.exceptions = exceptions
+        self.name = name
+        self.clock = clock
+        self._failures = 0
+        self._opened_at = None
+        self._probe_at = None  # Time the half-open probe was let through
+        self._exception = None  # Exception that opened the circuit
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        """str: One of 'closed', 'open' or 'half-open'."""
+        opened_at = self._opened_at
+        if opened_at is None:
+            return 'closed'
+        if self.clock() - opened_at < self.recovery_timeout:
+            return 'open'
+        return 'half-open'
+
+    def before_call(self):
+        """Raise copy of the exception that opened the circuit, unless the request can go through
+        to the backend.
+        """
+        if self._opened_at is None:
+            return
+
+        now = self.clock()
+        with self._lock:
+            if self._opened_at is None:
+                return
+            # Let one probe through, another one if it didn't finish in time
+            if (now - self._opened_at >= self.recovery_timeout and
+                    (self._probe_at is None or now - self._probe_at >= self.recovery_timeout)):
+                self._probe_at = now
+                return
+            exception = self._exception
+        raise _copy_exception(exception)
+
+    def record_success(self):
+        """Close the circuit and reset the failure count."""
+        if self._failures == 0 and self._opened_at is None:
+            return
+        if self._opened_at is not None:
+            logger.info('%s closed', self._label())
+        self.reset()
+
+    def record_failure(self, exception):
+        """Count exception raised while handling a request, open the circuit if it's one of the
+        ``exceptions`` and the threshold is reached or the probe failed.
+        """
+        if not isinstance(exception, self.exceptions):
+            self.record_success()
+            return
+
+        with self._lock:
+            self._failures += 1
+            if self._probe_at is None and self._failures < self.failure_threshold:
+                return
+            if self._opened_at is None:
+                logger.warning('%s opened after %d failures, last one: %r', self._label(),
+                               self._failures, exception)
+            self._opened_at = self.clock()
+            self._probe_at = None
+            self._exception = exception
+
+    def reset(self):
+        """Close the circuit."""
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probe_at = None
+            self._exception = None
+
+    def _label(self):
+        if self.name is None:
+            return 'Circuit'
+        return 'Circuit %s' % self.name
+
+
+def _copy_exception(exception):
+    # Copy without calling __init__, whose arguments differ between the exception classes. Every
+    # short-circuited request gets its own instance, so their tracebacks don't pile up.
+    copy = exception.__class__.__new__(exception.__class__)
+    copy.__dict__.update(exception.__dict__)
+    copy.args = exception.args
+    return copy
@@ -0,0 +1,75 @@
+"""JSON codecs for ``Smarthome.handle_bytes``. The fastest installed library is used by default:
+orjson, then ujson, then the standard library json module.
+"""
+import json
+
+
+class JsonCodec(object):
+    """Codec using the standard library json module."""
+    name = 'json'
+
+    def loads(self, raw):
+        """Decode JSON bytes to objects."""
+        if isinstance(raw, bytes):
+            raw = raw.decode('utf-8')
+        return json.loads(raw)
+
+    def dumps(self, obj):
+        """Encode objects to compact JSON bytes."""
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+class OrjsonCodec(object):
+    """Codec using the orjson library."""
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self.loads = orjson.loads
+        self.dumps = orjson.dumps
+
+
+class UjsonCodec(object):
+    """Codec using the ujson library."""
+    name = 'ujson'
+
+    def __init__(self):
+        import ujson
+        self._ujson = ujson
+        self.loads = ujson.loads
+
+    def dumps(self, obj):
+        return self._ujson.dumps(obj).encode('utf-8')
+
+
+_CODECS = (OrjsonCodec, UjsonCodec, JsonCodec)
+_default_codec = None
+
+
+def get_codec(name=None):
+    """Return codec instance.
+
+    Args:
+        name (str): One of 'orjson', 'ujson' or 'json'. The fastest installed one if None.
+
+    Raises:
+        ImportError: If the library of the requested codec isn't installed.
+
+    """
+    for codec_cls in _CODECS:
+        if name is not None and codec_cls.name != name:
+            continue
+        try:
+            return codec_cls()
+        except ImportError:
+            if name is not None:
+                raise
+    raise ValueError('Unknown codec %s' % name)
+
+
+def default_codec():
+    """Return shared instance of the fastest installed codec."""
+    global _default_codec
+    if _default_codec is None:
+        _default_codec = get_codec()
+    return _default_codec
@@ -1,25 +1,40 @@
+from .utils import FrozenDict
+
+
+class _ClassName(object):
+    """Descriptor returning name of the class the attribute is accessed on."""
+    def __get__(self, instance, owner):
+        return owner.__name__
+
+
 class AskhomeException(Exception):
     """Base askhome exception from which all inherit.
 
     These exceptions can be raised in ``Appliance`` actions or manually passed to
     ``Request.exception_response`` to create an error response.
+
+    The ``log_policy`` class attribute sets how ``Smarthome`` logs exceptions of the class raised
+    while handling requests. It can be 'traceback' (default), 'summary' without the traceback,
+    'none', or a float between 0 and 1 for logging with traceback only that fraction of them.
+    Set it on specific classes to keep routine errors from flooding the logs, e.g.
+    ``TargetOfflineError.log_policy = 'summary'``.
     """
     namespace = 'Alexa.ConnectedHome.Control'
-    
+    log_policy = 'traceback'
+
+    # Name in request header is same as class name. Exceptions without parameters share a
+    # read-only empty payload, so raising them allocates nothing else than the instance.
+    name = _ClassName()
+    payload = FrozenDict()
+
     def __init__(self, *args, **kwargs):
         """
         Args:
             name (str): Custom error name in header of generated response
             payload (dict): Custom payload of generated response
         """
-        # If payload was set in a subclass already, don't set it again
-        if not hasattr(self, 'payload'):
-            self.payload = {}
         if 'payload' in kwargs:
             self.payload = kwargs.pop('payload')
-
-        # Name in request header is same as class name
-        self.name = type(self).__name__
         if 'name' in kwargs:
             self.name = kwargs.pop('name')
 
@@ -0,0 +1,88 @@
+from .cache import TTLCache
+from . import logger
+
+
+class AppliancePool(object):
+    """Keeps ``Appliance`` instances alive between requests instead of creating one per request.
+
+    Set an instance to ``Smarthome.appliance_pool`` to enable it. The first request for an
+    appliance creates the instance as usual, every following request calls ``Appliance.bind``
+    on the pooled instance instead. Evicted instances get their ``Appliance.teardown`` called.
+
+    Instances are handed out exclusively: ``get`` takes the instance out of the pool and
+    ``release`` puts it back after the action finishes, so concurrent requests for the same
+    appliance get separate instances. Only one of them is kept when they're released. Instances
+    whose action raised an exception other than ``AskhomeException`` are discarded, those of
+    actions abandoned at the deadline once the action finishes.
+
+    With ``key='class'``, a single instance handles requests for all appliances of its class, so
+    it must not keep per appliance state outside of ``bind``.
+    """
+    def __init__(self, max_size=128, ttl=None, key='id'):
+        """
+        Args:
+            max_size (int): Maximum number of pooled instances, least recently used instances are
+                evicted first.
+            ttl (float): Seconds after which an instance is evicted and created again, None to
+                keep instances until they're pushed out.
+            key (str): Either 'id' for an instance per appliance or 'class' for an instance per
+                ``Appliance`` subclass.
+        """
+        if key not in ('id', 'class'):
+            raise ValueError("key must be 'id' or 'class'")
+        self.key = key
+        self.ttl = ttl
+        # Key -> (appliance, time of creation)
+        self._instances = TTLCache(max_size, ttl, on_evict=self._teardown)
+
+    def get(self, appliance_cls, request):
+        """Return instance of ``appliance_cls`` bound to request, reusing the pooled one if any.
+        The instance is removed from the pool until it's passed to ``release``.
+        """
+        entry = self._instances.take(self._key(appliance_cls, request.appliance_id))
+        if entry is None:
+            return appliance_cls(request)
+
+        appliance, created = entry
+        appliance.bind(request)
+        # Remember the creation time so that reusing the instance doesn't prolong its ttl
+        appliance._pool_created = created
+        return appliance
+
+    def release(self, appliance_cls, request, appliance):
+        """Return instance obtained from ``get`` for the request to the pool, replacing (and
+        tearing down) another instance released for the same key meanwhile.
+        """
+        now = self._instances.clock()
+        created = getattr(appliance, '_pool_created', now)
+        ttl = None
+        if self.ttl is not None:
+            ttl = self.ttl - (now - created)
+            if ttl <= 0:
+                appliance.teardown()
+                return
+        self._instances.set(self._key(appliance_cls, request.appliance_id), (appliance, created),
+                            ttl)
+
+    def discard(self, appliance):
+        """Tear down instance obtained from ``get`` instead of returning it to the pool."""
+        try:
+            appliance.teardown()
+        except Exception:
+            logger.exception('Teardown of %r failed', appliance)
+
+    def clear(self):
+        """Tear down and remove all pooled instances."""
+        self._instances.clear()
+
+    def __len__(self):
+        return len(self._instances)
+
+    def _key(self, appliance_cls, appliance_id):
+        if self.key == 'id':
+            return appliance_cls, appliance_id
+        return appliance_cls
+
+    @staticmethod
+    def _teardown(key, entry):
+        entry[0].teardown()
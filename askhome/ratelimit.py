@@ -0,0 +1,78 @@
+import threading
+
+from .exceptions import RateLimitExceededError
+from .utils import monotonic
+
+# Seconds in the time units accepted by RateLimitExceededError
+_TIME_UNITS = {
+    'MINUTE': 60,
+    'HOUR': 3600,
+    'DAY': 86400,
+}
+
+
+class RateLimit(object):
+    """Token bucket limiting requests to appliances, see ``Appliance.rate_limit``.
+
+    Every key (appliance id or class) has a bucket holding up to ``burst`` tokens, refilled at
+    ``rate`` tokens per ``time_unit``. Each request takes one token, requests finding the bucket
+    empty are answered with ``RateLimitExceededError``. The state is a pair of numbers per key
+    updated in a tiny critical section, so checking the limit costs about as much as a dict
+    lookup.
+    """
+    def __init__(self, rate, time_unit='HOUR', burst=None, max_keys=10000, clock=monotonic):
+        """
+        Args:
+            rate (int): Number of requests allowed per time unit.
+            time_unit (str): One of 'MINUTE', 'HOUR' or 'DAY'.
+            burst (int): Number of requests allowed at once after being idle, rate if None.
+            max_keys (int): Number of buckets above which refilled buckets are dropped.
+            clock (callable): Function returning current time in seconds.
+        """
+        if time_unit not in _TIME_UNITS:
+            raise ValueError('time_unit must be one of %s' % ', '.join(sorted(_TIME_UNITS)))
+        self.rate = rate
+        self.time_unit = time_unit
+        self.burst = rate if burst is None else burst
+        self.max_keys = max_keys
+        self.clock = clock
+        self._refill = float(rate) / _TIME_UNITS[time_unit]  # Tokens per second
+        self._buckets = {}  # key -> [tokens, time of last update]
+        self._lock = threading.Lock()
+
+    def acquire(self, key):
+        """Take a token from the bucket of the key, return False if there's none left."""
+        now = self.clock()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.max_keys:
+                    self._prune(now)
+                bucket = self._buckets[key] = [self.burst, now]
+            else:
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self._refill)
+                bucket[1] = now
+
+            if bucket[0] < 1:
+                return False
+            bucket[0] -= 1
+            return True
+
+    def exception(self):
+        """Return ``RateLimitExceededError`` describing this limit."""
+        return RateLimitExceededError(self.rate, self.time_unit)
+
+    def reset(self, key=None):
+        """Refill the bucket of the key, all buckets if None."""
+        with self._lock:
+            if key is None:
+                self._buckets.clear()
+            else:
+                self._buckets.pop(key, None)
+
+    def _prune(self, now):
+        # Full buckets are the same as missing ones, so they can be dropped
+        full = [key for key, (tokens, updated) in self._buckets.items()
+                if tokens + (now - updated) * self._refill >= self.burst]
+        for key in full:
+            del self._buckets[key]
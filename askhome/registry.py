@@ -0,0 +1,280 @@
+import json
+import mmap
+import sqlite3
+import struct
+import threading
+
+
+class ApplianceRegistry(object):
+    """Storage of appliances registered in ``Smarthome``, see ``Smarthome.appliances``.
+
+    Entries are ``(appliance_class, details)`` tuples keyed by appliance id, where details is the
+    dict sent in DiscoverAppliancesResponse. Subclasses implement ``get``, ``add``, ``remove``,
+    ``values`` and ``__len__``, dict-like access is built on top of them.
+
+    Attributes:
+        version (int): Number changed on every modification of the registry, so that
+            ``Smarthome`` notices changes made directly to the registry. None if the registry
+            doesn't track its modifications.
+
+    """
+    version = None
+
+    def get(self, appl_id, default=None):
+        """Return ``(appliance_class, details)`` tuple of the appliance, default if not found."""
+        raise NotImplementedError
+
+    def add(self, appl_id, appl_class, details):
+        """Add or replace appliance."""
+        raise NotImplementedError
+
+    def add_many(self, appliances):
+        """Add or replace appliances from an iterable of ``(appl_id, appl_class, details)``."""
+        for appl_id, appl_class, details in appliances:
+            self.add(appl_id, appl_class, details)
+
+    def remove(self, appl_id):
+        """Remove appliance, raise ``KeyError`` if it's not registered."""
+        raise NotImplementedError
+
+    def values(self):
+        """Iterate over ``(appliance_class, details)`` tuples of all appliances."""
+        raise NotImplementedError
+
+    def close(self):
+        """Release resources held by the registry."""
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def __contains__(self, appl_id):
+        return self.get(appl_id) is not None
+
+    def __getitem__(self, appl_id):
+        entry = self.get(appl_id)
+        if entry is None:
+            raise KeyError(appl_id)
+        return entry
+
+    def __setitem__(self, appl_id, entry):
+        self.add(appl_id, *entry)
+
+    def __delitem__(self, appl_id):
+        self.remove(appl_id)
+
+
+class DictRegistry(dict, ApplianceRegistry):
+    """In-memory registry, the default one. Behaves as a regular dict."""
+    version = 0
+
+    def add(self, appl_id, appl_class, details):
+        self[appl_id] = (appl_class, details)
+
+    def remove(self, appl_id):
+        del self[appl_id]
+
+    def __setitem__(self, appl_id, entry):
+        self.version += 1
+        dict.__setitem__(self, appl_id, entry)
+
+    def __delitem__(self, appl_id):
+        self.version += 1
+        dict.__delitem__(self, appl_id)
+
+    def _modifying(method):
+        def wrapper(self, *args, **kwargs):
+            self.version += 1
+            return method(self, *args, **kwargs)
+        wrapper.__name__ = method.__name__
+        return wrapper
+
+    clear = _modifying(dict.clear)
+    pop = _modifying(dict.pop)
+    popitem = _modifying(dict.popitem)
+    setdefault = _modifying(dict.setdefault)
+    update = _modifying(dict.update)
+    del _modifying
+
+
+class _ClassMap(object):
+    """Translates ``Appliance`` subclasses to names stored in files and back."""
+
+    def __init__(self, classes):
+        self.classes = {}
+        for appl_class in classes:
+            self.name(appl_class)
+
+    def name(self, appl_class):
+        name = '%s.%s' % (appl_class.__module__, appl_class.__name__)
+        self.classes[name] = appl_class
+        return name
+
+    def resolve(self, name):
+        try:
+            return self.classes[name]
+        except KeyError:
+            raise LookupError('Unknown appliance class %s, pass it in the registry classes' % name)
+
+
+class SQLiteRegistry(ApplianceRegistry):
+    """Registry stored in an SQLite database file, appliances are loaded only when requested.
+
+    The database can be filled beforehand (for example with ``Smarthome.add_appliances``) and
+    shipped with the Lambda function, so handling a request doesn't need to load the whole fleet.
+    Appliance classes are stored by their module and name, so all of them need to be passed to
+    the registry that reads them.
+    """
+
+    def __init__(self, path, classes=()):
+        """
+        Args:
+            path (str): Path to the database file, it's created if it doesn't exist.
+            classes (iterable): ``Appliance`` subclasses that can be stored in the database.
+        """
+        self._classes = _ClassMap(classes)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS appliances '
+                '(id TEXT PRIMARY KEY, class TEXT NOT NULL, details TEXT NOT NULL)')
+
+    def get(self, appl_id, default=None):
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT class, details FROM appliances WHERE id = ?', (appl_id,)).fetchone()
+        if row is None:
+            return default
+        return self._classes.resolve(row[0]), json.loads(row[1])
+
+    def add(self, appl_id, appl_class, details):
+        self.add_many([(appl_id, appl_class, details)])
+
+    def add_many(self, appliances):
+        rows = ((appl_id, self._classes.name(appl_class), json.dumps(details))
+                for appl_id, appl_class, details in appliances)
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO appliances (id, class, details) VALUES (?, ?, ?)', rows)
+
+    def remove(self, appl_id):
+        with self._lock, self._connection:
+            cursor = self._connection.execute('DELETE FROM appliances WHERE id = ?', (appl_id,))
+        if cursor.rowcount == 0:
+            raise KeyError(appl_id)
+
+    def values(self):
+        with self._lock:
+            rows = self._connection.execute('SELECT class, details FROM appliances').fetchall()
+        for class_name, details in rows:
+            yield self._classes.resolve(class_name), json.loads(details)
+
+    def close(self):
+        self._connection.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM appliances').fetchone()[0]
+
+
+class SnapshotRegistry(ApplianceRegistry):
+    """Read-only registry memory-mapped from a snapshot file created by ``SnapshotRegistry.write``.
+
+    Opening the snapshot doesn't read any appliances, lookups binary search the sorted index in
+    the mapped file, so only the touched pages are ever loaded. Like ``SQLiteRegistry``, it needs
+    the appliance classes stored in the snapshot.
+    """
+    # File layout: header, index entries sorted by appliance id, then the ids and JSON records
+    _MAGIC = b'ASKHOME1'
+    _HEADER = struct.Struct('<8sI')  # magic, appliance count
+    _ENTRY = struct.Struct('<IIII')  # id offset, id length, record offset, record length
+
+    def __init__(self, path, classes=()):
+        """
+        Args:
+            path (str): Path to the snapshot file.
+            classes (iterable): ``Appliance`` subclasses stored in the snapshot.
+        """
+        self._classes = _ClassMap(classes)
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self._count = self._HEADER.unpack_from(self._map, 0)
+        if magic != self._MAGIC:
+            raise ValueError('%s is not an appliance snapshot' % path)
+
+    @classmethod
+    def write(cls, path, appliances):
+        """Create snapshot file from appliances of another registry.
+
+        Args:
+            path (str): Path of the created file.
+            appliances (ApplianceRegistry|dict): Registry to take the appliances from, for example
+                ``Smarthome.appliances``.
+
+        """
+        classes = _ClassMap(())
+        entries = []
+        for appl_class, details in appliances.values():
+            record = json.dumps([classes.name(appl_class), details]).encode('utf-8')
+            entries.append((_to_bytes(details['applianceId']), record))
+        entries.sort()
+
+        data_offset = cls._HEADER.size + cls._ENTRY.size * len(entries)
+        index = []
+        data = []
+        for key, record in entries:
+            index.append(cls._ENTRY.pack(data_offset, len(key), data_offset + len(key),
+                                         len(record)))
+            data.append(key + record)
+            data_offset += len(key) + len(record)
+
+        with open(path, 'wb') as f:
+            f.write(cls._HEADER.pack(cls._MAGIC, len(entries)))
+            f.write(b''.join(index))
+            f.write(b''.join(data))
+
+    def get(self, appl_id, default=None):
+        key = _to_bytes(appl_id)
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            entry = self._entry(middle)
+            middle_key = self._map[entry[0]:entry[0] + entry[1]]
+            if middle_key < key:
+                low = middle + 1
+            elif middle_key > key:
+                high = middle
+            else:
+                return self._record(entry)
+        return default
+
+    def add(self, appl_id, appl_class, details):
+        raise TypeError('SnapshotRegistry is read-only')
+
+    def remove(self, appl_id):
+        raise TypeError('SnapshotRegistry is read-only')
+
+    def values(self):
+        for i in range(self._count):
+            yield self._record(self._entry(i))
+
+    def close(self):
+        self._map.close()
+
+    def __len__(self):
+        return self._count
+
+    def _entry(self, i):
+        return self._ENTRY.unpack_from(self._map, self._HEADER.size + i * self._ENTRY.size)
+
+    def _record(self, entry):
+        record = self._map[entry[2]:entry[2] + entry[3]]
+        class_name, details = json.loads(record.decode('utf-8'))
+        return self._classes.resolve(class_name), details
+
+
+def _to_bytes(text):
+    if isinstance(text, bytes):
+        return text
+    return text.encode('utf-8')
@@ -1,48 +1,90 @@
 from datetime import datetime
 
-from .utils import rstrip_word
+from .utils import monotonic, rstrip_word, with_metaclass
 
 
-def create_request(data, context=None):
-    """Create a specific ``Request`` subclass according to the request type.
-
-    Each ``Request`` subclass has specific properties to access request data more easily and differing
-    ``response`` arguments for direct response creation.
-    """
-    name = data['header']['name']
-
-    # Return Request subtype for specific requests
-    if name == 'DiscoverAppliancesRequest':
-        return DiscoverRequest(data, context)
+# Registry of Request subclasses keyed by (request name, payload version). Payload version None
+# matches requests of any version.
+_request_classes = {}
 
-    if name in ('IncrementPercentageRequest',
-                'DecrementPercentageRequest',
-                'SetPercentageRequest'):
-        return PercentageRequest(data, context)
 
-    if name in ('IncrementTargetTemperatureRequest',
-                'DecrementTargetTemperatureRequest',
-                'SetTargetTemperatureRequest'):
-        return ChangeTemperatureRequest(data, context)
+def register_request(request_cls, name, payload_version=None):
+    """Register ``Request`` subclass for requests with given name in header.
 
-    if name == 'GetTargetTemperatureRequest':
-        return GetTargetTemperatureRequest(data, context)
+    Subclasses with the ``request_names`` attribute are registered automatically, this function
+    is useful for reusing an existing class for a new request name.
 
-    if name == 'GetTemperatureReadingRequest':
-        return TemperatureReadingRequest(data, context)
-
-    if name in ('SetLockStateRequest', 'GetLockStateRequest'):
-        return LockStateRequest(data, context)
+    Args:
+        request_cls (type): ``Request`` subclass created for matching requests.
+        name (str): Request name from the ``name`` field in header.
+        payload_version (str): Register only for requests with this ``payloadVersion``, all
+            versions if None. Version specific classes take precedence.
 
-    if name == 'HealthCheckRequest':
-        return HealthCheckRequest(data, context)
+    """
+    _request_classes[(name, payload_version)] = request_cls
 
-    return Request(data, context)
 
+def create_request(data, context=None):
+    """Create a specific ``Request`` subclass according to the request type.
 
-class Request(object):
+    Each ``Request`` subclass has specific properties to access request data more easily and differing
+    ``response`` arguments for direct response creation. Unknown requests create plain ``Request``.
+    """
+    header = data['header']
+    name = header['name']
+
+    request_cls = _request_classes.get((name, header.get('payloadVersion')))
+    if request_cls is None:
+        request_cls = _request_classes.get((name, None), Request)
+
+    return request_cls(data, context)
+
+
+def _response_name(namespace, request_name):
+    # Control requests have confirmations instead of responses
+    name = rstrip_word(request_name, 'Request')
+    if namespace == 'Alexa.ConnectedHome.Control':
+        return name + 'Confirmation'
+    return name + 'Response'
+
+
+# Response names of all Smart Home Skill API requests precomputed at import, keyed by
+# (namespace, request name). Other requests get their response name computed every time.
+_RESPONSE_NAMES = dict(((namespace, name), _response_name(namespace, name))
+                       for namespace, names in (
+    ('Alexa.ConnectedHome.Control', (
+        'TurnOnRequest', 'TurnOffRequest',
+        'SetPercentageRequest', 'IncrementPercentageRequest', 'DecrementPercentageRequest',
+        'SetTargetTemperatureRequest', 'IncrementTargetTemperatureRequest',
+        'DecrementTargetTemperatureRequest',
+        'SetLockStateRequest',
+        'SetColorRequest', 'SetColorTemperatureRequest', 'IncrementColorTemperatureRequest',
+        'DecrementColorTemperatureRequest',
+    )),
+    ('Alexa.ConnectedHome.Query', (
+        'GetTargetTemperatureRequest', 'GetTemperatureReadingRequest', 'GetLockStateRequest',
+    )),
+    ('Alexa.ConnectedHome.Discovery', ('DiscoverAppliancesRequest',)),
+    ('Alexa.ConnectedHome.System', ('HealthCheckRequest',)),
+) for name in names)
+
+
+class _RequestMeta(type):
+    """Metaclass registering ``Request`` subclasses for the names in their ``request_names``."""
+    def __init__(cls, name, bases, namespace):
+        super(_RequestMeta, cls).__init__(name, bases, namespace)
+        # Only names declared directly in the class, subclasses don't take over parent's names
+        for request_name in namespace.get('request_names', ()):
+            register_request(cls, request_name, cls.payload_version)
+
+
+class Request(with_metaclass(_RequestMeta)):
     """Base Request class for parsing Alexa request data.
 
+    Subclasses can set the ``request_names`` class attribute to a tuple of request names they
+    should be created for by ``create_request``. Setting also the ``payload_version`` class
+    attribute limits them to requests with that ``payloadVersion`` in header.
+
     Attributes:
         data (dict): Raw event data from the lambda handler.
         context (object): Context object from the lambda handler.
@@ -51,9 +93,23 @@ class Request(object):
         name (str): Request name from the ``name`` field in header.
         access_token (str): OAuth token from the ``accessToken`` field in payload.
         custom_data (Any): Attribute for saving custom data through
-            ``Smarthome.prepare_handler``
-
+            ``Smarthome.prepare_handler``. Empty dict is created on first access.
+        state_cache (StateCache): Cache of appliance states set from ``Smarthome.state_cache``,
+            responses of control and query requests are recorded in it. None if not set.
+        token_info (Any): Result of the ``Smarthome.token_validator`` for the access token. None
+            if there's no validator.
+        deadline (float): Time (of ``askhome.utils.monotonic`` clock) by which the response has
+            to be ready, computed from the Lambda context when ``Smarthome.deadline_margin`` is
+            set. None if there's no deadline.
+
+    Requests use ``__slots__``, so custom attributes can't be set on instances of the built-in
+    classes, use ``custom_data`` instead.
     """
+    __slots__ = ('data', 'context', 'header', 'payload', 'name', 'access_token', 'state_cache',
+                 'deadline', 'token_info', '_custom_data', '_appliance_id')
+    request_names = ()
+    payload_version = None
+
     def __init__(self, data, context=None):
         self.data = data
         self.context = context
@@ -62,14 +118,41 @@ class Request(object):
         self.payload = data['payload']
         self.name = self.header['name']
         self.access_token = self.payload.get('accessToken', None)
-        self.custom_data = {}
+        self.state_cache = None
+        self.deadline = None
+        self.token_info = None
+
+    @property
+    def custom_data(self):
+        """Any: Custom data saved through ``Smarthome.prepare_handler``, empty dict by default."""
+        try:
+            return self._custom_data
+        except AttributeError:
+            self._custom_data = {}
+            return self._custom_data
+
+    @custom_data.setter
+    def custom_data(self, value):
+        self._custom_data = value
 
     @property
     def appliance_id(self):
         """str: Identifier of the appliance from the appliance.applianceId of request payload."""
-        if 'appliance' not in self.payload:
+        try:
+            return self._appliance_id
+        except AttributeError:
+            appliance = self.payload.get('appliance')
+            self._appliance_id = None if appliance is None else appliance['applianceId']
+            return self._appliance_id
+
+    @property
+    def remaining_time(self):
+        """float: Seconds left until ``deadline``, never negative. None if there's no deadline.
+        Useful as timeout of calls to device backends.
+        """
+        if self.deadline is None:
             return None
-        return self.payload['appliance']['applianceId']
+        return max(0.0, self.deadline - monotonic())
 
     @property
     def appliance_details(self):
@@ -83,15 +166,13 @@ class Request(object):
     def response_header(self, name=None):
         """Generate response header with copied values from the request and correct name."""
         if name is None:
-            # Figure out response name - Control requests have confirmations instead of responses
-            name = rstrip_word(self.name, 'Request')
-            if self.header['namespace'] == 'Alexa.ConnectedHome.Control':
-                name += 'Confirmation'
-            else:
-                name += 'Response'
+            namespace = self.header['namespace']
+            name = _RESPONSE_NAMES.get((namespace, self.name))
+            if name is None:
+                name = _response_name(namespace, self.name)
 
         # Copy request header and just change the name
-        header = dict(self.header)
+        header = self.header.copy()
         header['name'] = name
 
         return header
@@ -111,14 +192,53 @@ class Request(object):
         """
         return self.raw_response()
 
+    def cached_response(self, max_age=None):
+        """Return response built from the appliance state in ``state_cache``, None if there's no
+        state cached for this appliance and request name.
+
+        The ``applianceResponseTimestamp`` of the response is the time the state was recorded.
+        Useful for query requests of slowly changing states::
+
+            return request.cached_response(max_age=60) or request.response(query_device())
+
+        Args:
+            max_age (float): Ignore states recorded more than this many seconds ago.
+
+        """
+        if self.state_cache is None:
+            return None
+        state = self.state_cache.get(self.appliance_id, self.name, max_age)
+        if state is None:
+            return None
+        payload, timestamp = state
+        return self.raw_response(dict(payload,
+                                      applianceResponseTimestamp=self._format_timestamp(timestamp)))
+
     def exception_response(self, exception):
         """Create response from exception instance."""
         # Use exception class name as response name
-        header = self.response_header(exception.name)
+        header = self.header.copy()
+        header['name'] = exception.name
         header['namespace'] = exception.namespace
 
         return {'header': header, 'payload': exception.payload}
 
+    def _payload_float(self, attr, key):
+        # Parse the value of payload field once and cache it in the attr slot
+        try:
+            return getattr(self, attr)
+        except AttributeError:
+            value = None
+            if key in self.payload:
+                value = float(self.payload[key]['value'])
+            setattr(self, attr, value)
+            return value
+
+    def _record_state(self, name, payload, timestamp=None):
+        # Save response payload for query requests of the name, see cached_response
+        if self.state_cache is not None and self.appliance_id is not None:
+            self.state_cache.set(self.appliance_id, name, dict(payload), timestamp)
+
     @staticmethod
     def _format_timestamp(timestamp):
         if isinstance(timestamp, datetime):
@@ -130,47 +250,50 @@ class Request(object):
 
 class DiscoverRequest(Request):
     """Request class for Alexa DiscoverAppliancesRequest."""
+    __slots__ = ()
+    request_names = ('DiscoverAppliancesRequest',)
+
     def response(self, smarthome):
         """Generate DiscoverAppliancesResponse from appliances added to the passed ``Smarthome``.
 
         Details of each appliance are resolved in order of priority:
         ``Smarthome.add_appliance`` kwargs -> ``Appliance.Details`` -> ``Smarthome.__init__`` kwargs
+        The payload is cached in ``Smarthome.discovery_payload``, only the header is created for
+        each request.
         """
-        discovered = []
-        for appl, details in smarthome.appliances.values():
-            discovered.append(details)
-
-        return self.raw_response({'discoveredAppliances': discovered})
+        return self.raw_response(smarthome.discovery_payload)
 
 
 class PercentageRequest(Request):
     """Request class for Alexa Increment/Decrement/SetPercentageRequest."""
+    request_names = ('IncrementPercentageRequest', 'DecrementPercentageRequest',
+                     'SetPercentageRequest')
+
+    __slots__ = ('_percentage', '_delta_percentage')
+
     @property
     def percentage(self):
-        if 'percentageState' not in self.payload:
-            return None
-        return float(self.payload['percentageState']['value'])
+        return self._payload_float('_percentage', 'percentageState')
 
     @property
     def delta_percentage(self):
-        if 'deltaPercentage' not in self.payload:
-            return None
-        return float(self.payload['deltaPercentage']['value'])
+        return self._payload_float('_delta_percentage', 'deltaPercentage')
 
 
 class ChangeTemperatureRequest(Request):
     """Request class for Alexa Increment/Decrement/SetTargetTemperatureRequest."""
+    request_names = ('IncrementTargetTemperatureRequest', 'DecrementTargetTemperatureRequest',
+                     'SetTargetTemperatureRequest')
+
+    __slots__ = ('_temperature', '_delta_temperature')
+
     @property
     def temperature(self):
-        if 'targetTemperature' not in self.payload:
-            return None
-        return float(self.payload['targetTemperature']['value'])
+        return self._payload_float('_temperature', 'targetTemperature')
 
     @property
     def delta_temperature(self):
-        if 'deltaTemperature' not in self.payload:
-            return None
-        return float(self.payload['deltaTemperature']['value'])
+        return self._payload_float('_delta_temperature', 'deltaTemperature')
 
     def response(self, temperature, mode=None, previous_temperature=None, previous_mode=None):
         """
@@ -188,6 +311,8 @@ class ChangeTemperatureRequest(Request):
 
         if mode is not None:
             payload['temperatureMode'] = {'value': mode}
+        if self.state_cache is not None and self.appliance_id is not None:
+            self._record_target_temperature(payload)
 
         # Even though the docs say the previousState is required, it works fine without it
         if previous_temperature is not None:
@@ -202,9 +327,28 @@ class ChangeTemperatureRequest(Request):
 
         return self.raw_response(payload)
 
+    def _record_target_temperature(self, payload):
+        # The query response needs the mode too, keep the cached one if the device didn't say
+        name = 'GetTargetTemperatureRequest'
+        mode = payload.get('temperatureMode')
+        if mode is None:
+            cached = self.state_cache.get(self.appliance_id, name)
+            if cached is None or 'temperatureMode' not in cached[0]:
+                # Recording a made up mode would answer queries with it
+                self.state_cache.invalidate(self.appliance_id, name)
+                return
+            mode = cached[0]['temperatureMode']
+        self._record_state(name, {
+            'targetTemperature': payload['targetTemperature'],
+            'temperatureMode': mode,
+        })
+
 
 class GetTargetTemperatureRequest(Request):
     """Request class for Alexa GetTargetTemperatureRequest."""
+    __slots__ = ()
+    request_names = ('GetTargetTemperatureRequest',)
+
     def response(self, temperature=None, cooling_temperature=None, heating_temperature=None,
                  mode='AUTO', mode_name=None, timestamp=None):
         """
@@ -235,6 +379,7 @@ class GetTargetTemperatureRequest(Request):
             payload['temperatureMode'] = {'value': mode}
         if mode_name is not None:
             payload['temperatureMode']['friendlyName'] = mode_name
+        self._record_state(self.name, payload, timestamp)
         # Add timestamp to payload if set
         if timestamp is not None:
             payload['applianceResponseTimestamp'] = self._format_timestamp(timestamp)
@@ -244,6 +389,9 @@ class GetTargetTemperatureRequest(Request):
 
 class TemperatureReadingRequest(Request):
     """Request class for Alexa GetTemperatureReadingRequest."""
+    __slots__ = ()
+    request_names = ('GetTemperatureReadingRequest',)
+
     def response(self, temperature, timestamp=None):
         """
         Args:
@@ -251,6 +399,7 @@ class TemperatureReadingRequest(Request):
             timestamp (datetime|str): Time when the information was last retrieved.
         """
         payload = {'temperatureReading': {'value': temperature}}
+        self._record_state(self.name, payload, timestamp)
         # Add timestamp to payload if set
         if timestamp is not None:
             payload['applianceResponseTimestamp'] = self._format_timestamp(timestamp)
@@ -259,6 +408,9 @@ class TemperatureReadingRequest(Request):
 
 class LockStateRequest(Request):
     """Request class for Alexa Get/SetLockStateRequest."""
+    __slots__ = ()
+    request_names = ('SetLockStateRequest', 'GetLockStateRequest')
+
     @property
     def lock_state(self):
         return self.payload['lockState']
@@ -271,6 +423,7 @@ class LockStateRequest(Request):
             timestamp (datetime|str): Time when the information was last retrieved.
         """
         payload = {'lockState': lock_state}
+        self._record_state('GetLockStateRequest', payload, timestamp)
         # Add timestamp to payload if set
         if timestamp is not None:
             payload['applianceResponseTimestamp'] = self._format_timestamp(timestamp)
@@ -279,6 +432,9 @@ class LockStateRequest(Request):
 
 class HealthCheckRequest(Request):
     """Request class for Alexa HealthCheckRequest."""
+    __slots__ = ()
+    request_names = ('HealthCheckRequest',)
+
     def response(self, healthy, description):
         return self.raw_response({
             'isHealthy': healthy,
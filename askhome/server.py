@@ -0,0 +1,470 @@
+"""HTTP server exposing ``Smarthome`` outside of AWS Lambda, for load testing and local bridges.
+Requires Python 3.7+, it only uses the standard library and runs on uvloop when it's installed::
+
+    $ python -m askhome.server my_skill:home --port 8080 --workers 16
+
+Every POST request to the configured path is one event encoded as JSON, the response body is the
+same as from ``Smarthome.handle_bytes``. Connections are kept alive, synchronous handling runs
+in a thread pool so slow actions don't block the event loop. To use multiple cores, serve from
+pre-forked worker processes with ``--processes`` (see ``serve_workers``), or start several servers
+with ``--reuse-port`` on the same port.
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from timeit import default_timer
+
+from . import logger
+
+_REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+    500: 'Internal Server Error',
+}
+
+# Workers exiting sooner than this after start count as failing to start. Their restarts are
+# delayed exponentially from _RESTART_DELAY up to _MAX_RESTART_DELAY seconds and serve_workers
+# gives up after _MAX_FAST_FAILURES of them in a row.
+_MIN_UPTIME = 5
+_RESTART_DELAY = 0.1
+_MAX_RESTART_DELAY = 10
+_MAX_FAST_FAILURES = 5
+
+
+class ServerStats(object):
+    """Counters of handled HTTP requests, kept in shared memory so that pre-forked workers can
+    each write their own slot and any process can read the totals.
+
+    Attributes:
+        slot (int): Index of the worker writing to the stats in this process.
+
+    """
+    _FIELDS = ('requests', 'errors', 'seconds')
+
+    def __init__(self, workers=1):
+        """
+        Args:
+            workers (int): Number of worker slots.
+        """
+        self.workers = workers
+        self.slot = 0
+        self._values = multiprocessing.RawArray('d', workers * len(self._FIELDS))
+
+    def record(self, status, duration):
+        """Count a request responded to with HTTP status, handled in duration seconds."""
+        base = self.slot * len(self._FIELDS)
+        self._values[base] += 1
+        if status >= 400:
+            self._values[base + 1] += 1
+        self._values[base + 2] += duration
+
+    def worker(self, slot):
+        """Return dict with the counters of one worker."""
+        base = slot * len(self._FIELDS)
+        return dict(zip(self._FIELDS, self._values[base:base + len(self._FIELDS)]))
+
+    def totals(self):
+        """Return dict with the counters summed over all workers, and the per worker counters
+        under ``workers``.
+        """
+        workers = [self.worker(slot) for slot in range(self.workers)]
+        totals = {field: sum(worker[field] for worker in workers) for field in self._FIELDS}
+        totals['workers'] = workers
+        return totals
+
+
+class SmarthomeServer(object):
+    """HTTP/1.1 server handling request bodies like ``Smarthome.handle_bytes``. Bodies that can't
+    be decoded are answered with 400, exceptions raised while handling the event with 500.
+
+    Use ``run`` to serve until SIGINT or SIGTERM, or ``start`` and ``close`` to control the
+    server from a running event loop.
+    """
+
+    def __init__(self, smarthome, host='127.0.0.1', port=8080, path='/', workers=None,
+                 use_async=False, reuse_port=False, keep_alive_timeout=75,
+                 max_body_size=1024 * 1024, stats=None, stats_path=None):
+        """
+        Args:
+            smarthome (Smarthome): Smarthome handling the events.
+            host (str): Address to listen on.
+            port (int): Port to listen on, 0 picks a free one (see ``port`` after ``start``).
+            path (str): URL path accepting the events, other paths respond with 404.
+            workers (int): Size of the thread pool handling events, default of
+                ``ThreadPoolExecutor`` if None.
+            use_async (bool): Handle events with ``Smarthome.async_lambda_handler`` in the event
+                loop instead of the thread pool. Use it when actions are coroutine functions.
+            reuse_port (bool): Allow other processes to listen on the same port (``SO_REUSEPORT``),
+                the kernel then balances connections between them.
+            keep_alive_timeout (float): Seconds after which idle connections are closed.
+            max_body_size (int): Largest accepted event in bytes, bigger ones respond with 413.
+            stats (ServerStats): Counters of handled requests, a new one if None.
+            stats_path (str): URL path responding to GET requests with the stats as JSON, summed
+                over all workers. Disabled if None.
+        """
+        self.smarthome = smarthome
+        self.host = host
+        self.port = port
+        self.path = path
+        self.workers = workers
+        self.use_async = use_async
+        self.reuse_port = reuse_port
+        self.keep_alive_timeout = keep_alive_timeout
+        self.max_body_size = max_body_size
+        self.stats = ServerStats() if stats is None else stats
+        self.stats_path = stats_path
+
+        self._server = None
+        self._executor = None
+        self._connections = set()
+        self._idle = set()
+        self._closing = False
+
+    async def start(self, sock=None):
+        """Start listening, on ``sock`` instead of host and port if passed."""
+        self._closing = False
+        self._executor = ThreadPoolExecutor(self.workers)
+        if sock is not None:
+            self._server = await asyncio.start_server(self._handle_connection, sock=sock)
+        else:
+            self._server = await asyncio.start_server(
+                self._handle_connection, self.host, self.port, reuse_port=self.reuse_port or None)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info('Serving on %s:%d', self.host, self.port)
+
+    async def close(self, timeout=30):
+        """Stop the server gracefully.
+
+        New connections are refused and idle ones closed right away, requests being handled are
+        finished and responded to (for at most ``timeout`` seconds) before their connections close.
+        """
+        self._closing = True
+        self._server.close()
+
+        for writer in list(self._idle):
+            writer.close()
+        if self._connections:
+            done, pending = await asyncio.wait(set(self._connections), timeout=timeout)
+            for task in pending:
+                task.cancel()
+        await self._server.wait_closed()
+
+        self._executor.shutdown(wait=True)
+        logger.info('Server closed')
+
+    async def serve_forever(self, handle_signals=True, sock=None):
+        """Start the server and serve until SIGINT or SIGTERM, then close it gracefully.
+
+        Args:
+            handle_signals (bool): Install signal handlers, possible only in the main thread.
+                Cancel the task to stop the server otherwise.
+            sock (socket.socket): Listening socket to serve on instead of host and port.
+
+        """
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        if handle_signals:
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(signum, stop.set)
+
+        await self.start(sock)
+        try:
+            await stop.wait()
+        finally:
+            await self.close()
+            if handle_signals:
+                for signum in (signal.SIGINT, signal.SIGTERM):
+                    loop.remove_signal_handler(signum)
+
+    def run(self, use_uvloop=None, sock=None):
+        """Run the server in a new event loop until SIGINT or SIGTERM.
+
+        Args:
+            use_uvloop (bool): Run on uvloop, raise ``ImportError`` if it isn't installed. Use it
+                when available if None.
+            sock (socket.socket): Listening socket to serve on instead of host and port.
+
+        """
+        if use_uvloop or use_uvloop is None:
+            try:
+                import uvloop
+            except ImportError:
+                if use_uvloop:
+                    raise
+            else:
+                asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        asyncio.run(self.serve_forever(sock=sock))
+
+    async def _handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while not self._closing:
+                self._idle.add(writer)
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(),
+                                                          self.keep_alive_timeout)
+                except asyncio.TimeoutError:
+                    break
+                finally:
+                    self._idle.discard(writer)
+                if not request_line:
+                    break
+
+                keep_alive = await self._handle_request(request_line, reader, writer)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    async def _handle_request(self, request_line, reader, writer):
+        """Read one request from the connection and write its response.
+
+        Returns:
+            bool: Whether the connection can be kept alive.
+
+        """
+        try:
+            method, target, version = request_line.decode('latin-1').split()
+        except ValueError:
+            self._write_response(writer, 400, b'', False)
+            return False
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.1':
+            keep_alive = connection != 'close'
+        else:
+            keep_alive = connection == 'keep-alive'
+        keep_alive = keep_alive and not self._closing
+
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            self._write_response(writer, 400, b'', False)
+            return False
+        if length > self.max_body_size:
+            self._write_response(writer, 413, b'', False)
+            return False
+        body = await reader.readexactly(length)
+
+        start = default_timer()
+        status, response = await self._respond(method, target, body)
+        self.stats.record(status, default_timer() - start)
+        keep_alive = keep_alive and not self._closing
+        self._write_response(writer, status, response, keep_alive)
+        return keep_alive
+
+    async def _respond(self, method, target, body):
+        path = target.split('?', 1)[0]
+        if path == self.stats_path and method == 'GET':
+            return 200, json.dumps(self.stats.totals()).encode('utf-8')
+        if path != self.path:
+            return 404, b''
+        if method != 'POST':
+            return 405, b''
+
+        try:
+            data = self.smarthome.decode_event(body)
+        except ValueError:
+            # Raised by codecs for malformed JSON, exceptions of the handlers are server errors
+            logger.info('Malformed event received', exc_info=True)
+            return 400, b''
+
+        try:
+            if self.use_async:
+                response = await self.smarthome.async_lambda_handler(data)
+            else:
+                loop = asyncio.get_running_loop()
+                response = await loop.run_in_executor(self._executor,
+                                                      self.smarthome.lambda_handler, data)
+            return 200, self.smarthome.encode_response(response)
+        except Exception:
+            logger.exception('Unhandled exception while handling event')
+            return 500, b''
+
+    @staticmethod
+    def _write_response(writer, status, body, keep_alive):
+        head = ('HTTP/1.1 %d %s\r\n'
+                'Content-Type: application/json\r\n'
+                'Content-Length: %d\r\n'
+                'Connection: %s\r\n\r\n'
+                % (status, _REASONS[status], len(body), 'keep-alive' if keep_alive else 'close'))
+        writer.write(head.encode('latin-1') + body)
+
+
+def serve(smarthome, host='127.0.0.1', port=8080, use_uvloop=None, **kwargs):
+    """Serve ``smarthome`` over HTTP until SIGINT or SIGTERM, see ``SmarthomeServer``."""
+    SmarthomeServer(smarthome, host, port, **kwargs).run(use_uvloop)
+
+
+def serve_workers(smarthome, host='127.0.0.1', port=8080, processes=None, use_uvloop=None,
+                  **kwargs):
+    """Serve ``smarthome`` over HTTP from pre-forked worker processes until SIGINT or SIGTERM.
+
+    The parent process freezes the smarthome (see ``Smarthome.freeze``), so its appliances are
+    built only once and shared copy-on-write with the workers, then opens the listening socket and
+    forks the workers. The kernel balances connections between the workers accepting on the
+    shared socket. Workers that exit unexpectedly are restarted, with an increasing delay when they
+    exit right after starting. On SIGINT or SIGTERM the workers are shut down gracefully.
+
+    Args:
+        smarthome (Smarthome): Smarthome handling the events, with all appliances added.
+        processes (int): Number of worker processes, number of CPUs if None.
+        kwargs: Other arguments of ``SmarthomeServer``.
+
+    Returns:
+        ServerStats: Counters of requests handled by the workers.
+
+    Raises:
+        RuntimeError: If a worker keeps exiting right after starting, e.g. because of missing
+            dependencies. The other workers are shut down first.
+
+    """
+    processes = processes or os.cpu_count()
+    stats = ServerStats(processes)
+    smarthome.freeze()
+
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(1024)
+    sock.setblocking(False)
+    logger.info('Serving on %s:%d with %d workers', host, sock.getsockname()[1], processes)
+
+    workers = {}  # pid -> slot
+    started = {}  # slot -> time the worker was started
+    fast_failures = {}  # slot -> number of times in a row the worker exited right after start
+    stopping = []
+    failed_slot = None
+
+    def spawn(slot):
+        started[slot] = time.monotonic()
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            code = 0
+            try:
+                stats.slot = slot
+                SmarthomeServer(smarthome, host, port, stats=stats, **kwargs).run(use_uvloop, sock)
+            except BaseException:
+                logger.exception('Worker %d failed', slot)
+                code = 1
+            finally:
+                os._exit(code)
+        workers[pid] = slot
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+
+    previous = {signum: signal.signal(signum, stop) for signum in (signal.SIGINT, signal.SIGTERM)}
+    try:
+        for slot in range(processes):
+            if not stopping:
+                spawn(slot)
+        while workers:
+            pid, status = os.wait()
+            slot = workers.pop(pid, None)
+            if slot is None or stopping:
+                continue
+
+            if time.monotonic() - started[slot] >= _MIN_UPTIME:
+                fast_failures[slot] = 0
+            else:
+                fast_failures[slot] = fast_failures.get(slot, 0) + 1
+                if fast_failures[slot] >= _MAX_FAST_FAILURES:
+                    logger.error('Worker %d %s %d times right after starting, giving up', slot,
+                                 _describe_exit(status), fast_failures[slot])
+                    stop(None, None)
+                    failed_slot = slot
+                    continue
+
+            delay = 0
+            if fast_failures[slot]:
+                delay = min(_RESTART_DELAY * 2 ** (fast_failures[slot] - 1), _MAX_RESTART_DELAY)
+            logger.warning('Worker %d %s, restarting in %.1f s', slot, _describe_exit(status),
+                           delay)
+            time.sleep(delay)
+            if not stopping:
+                spawn(slot)
+    finally:
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
+        sock.close()
+
+    if failed_slot is not None:
+        raise RuntimeError('Worker %d keeps exiting right after starting' % failed_slot)
+    logger.info('Workers stopped, handled %d requests', stats.totals()['requests'])
+    return stats
+
+
+def _describe_exit(status):
+    # Decode status returned by os.wait
+    if os.WIFSIGNALED(status):
+        return 'was killed by signal %d' % os.WTERMSIG(status)
+    return 'exited with status %d' % os.WEXITSTATUS(status)
+
+
+def _load_smarthome(spec):
+    module_name, _, attr = spec.partition(':')
+    return getattr(importlib.import_module(module_name), attr or 'home')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve a Smarthome over HTTP.')
+    parser.add_argument('smarthome', help='module:attribute of the Smarthome, attribute defaults '
+                                          'to "home"')
+    parser.add_argument('--host', default='127.0.0.1', help='(default: %(default)s)')
+    parser.add_argument('--port', type=int, default=8080, help='(default: %(default)s)')
+    parser.add_argument('--path', default='/', help='URL path of the events (default: %(default)s)')
+    parser.add_argument('--workers', type=int, help='threads handling events in every process')
+    parser.add_argument('--processes', type=int,
+                        help='serve from this many pre-forked worker processes')
+    parser.add_argument('--stats-path', help='URL path responding with request stats')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='handle events with async_lambda_handler in the event loop')
+    parser.add_argument('--reuse-port', action='store_true',
+                        help='share the port with other server processes')
+    parser.add_argument('--no-uvloop', dest='use_uvloop', action='store_false', default=None,
+                        help="don't use uvloop even if it's installed")
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, '')
+    kwargs = dict(use_uvloop=args.use_uvloop, path=args.path, workers=args.workers,
+                  use_async=args.use_async, reuse_port=args.reuse_port,
+                  stats_path=args.stats_path)
+    smarthome = _load_smarthome(args.smarthome)
+    if args.processes:
+        serve_workers(smarthome, args.host, args.port, args.processes, **kwargs)
+    else:
+        serve(smarthome, args.host, args.port, **kwargs)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,34 +1,134 @@
+import gc
 import json
+import logging
+import numbers
+import random
+import sys
+from collections import OrderedDict
+from functools import partial
 
-from .exceptions import AskhomeException, UnsupportedTargetError, UnsupportedOperationError
+from .codec import default_codec
+from .exceptions import (AskhomeException, UnsupportedTargetError, UnsupportedOperationError,
+                         DriverInternalError, TargetOfflineError, InvalidAccessTokenError,
+                         ExpiredAccessTokenError)
+from .registry import ApplianceRegistry, DictRegistry
 from .requests import create_request
+from .utils import (FrozenDict, FrozenList, LazyJson, HandlerCall, Stopwatch, call_with_timeout,
+                    map_in_threads, monotonic)
 from . import logger
 
+if sys.version_info >= (3, 5):
+    from .aio import AsyncSmarthomeMixin
+else:
+    AsyncSmarthomeMixin = object
 
-class Smarthome(object):
+
+# Arguments of Smarthome.add_appliance in order
+_ADD_APPLIANCE_ARGS = ('appl_id', 'appl_class', 'name', 'description', 'additional_details',
+                       'model', 'version', 'manufacturer', 'reachable', 'rate_limit')
+
+# Appliance details as (add_appliance argument, DiscoverAppliancesResponse key, default value)
+_DETAILS = (
+    ('name', 'friendlyName', ''),
+    ('description', 'friendlyDescription', 'No description'),
+    ('additional_details', 'additionalApplianceDetails', FrozenDict()),
+    ('model', 'modelName', 'Unknown model'),
+    ('version', 'version', 'v1'),
+    ('manufacturer', 'manufacturerName', 'Unknown manufacturer'),
+    ('reachable', 'isReachable', True),
+)
+
+
+def _freeze_details(details):
+    # Read-only copy of appliance details, unless they already are
+    if isinstance(details, FrozenDict):
+        return details
+    details = dict(details)
+    actions = details.get('actions')
+    if isinstance(actions, list) and not isinstance(actions, FrozenList):
+        details['actions'] = FrozenList(actions)
+    additional = details.get('additionalApplianceDetails')
+    if isinstance(additional, dict) and not isinstance(additional, FrozenDict):
+        details['additionalApplianceDetails'] = FrozenDict(additional)
+    return FrozenDict(details)
+
+
+class Smarthome(AsyncSmarthomeMixin):
     """Holds information about all appliances and handles routing requests to appliance actions.
 
     Attributes:
-        appliances (dict(str, (Appliance, dict))): All registered appliances with details dict.
+        appliances (ApplianceRegistry): All registered appliances with details dict.
         details (dict): Defaults for details of appliances during DiscoverAppliancesRequest.
+        payload_log_level (int): Logging level of the request and response payloads logged in
+            ``lambda_handler``. Payloads are serialized only when the ``askhome`` logger has
+            this level enabled. Defaults to ``logging.DEBUG``.
+        payload_log_indent (int): JSON indentation of logged payloads, ``None`` logs them in
+            compact form. Defaults to 2.
+        payload_log_sample_rate (float): Fraction of requests whose payloads are logged, between
+            0 and 1. Useful together with ``payload_log_level`` to keep logging some requests in
+            production. Defaults to 1.
+        appliance_pool (AppliancePool): Pool reusing ``Appliance`` instances across requests.
+            Appliances are created for every request if None (default).
+        discovery_cache (DiscoveryCache): Cache of ``discover_handler`` responses per user.
+            Handler is called for every discovery if None (default).
+        appliance_class_cache (TTLCache): Cache of ``get_appliance_handler`` results keyed by
+            appliance id and additional details of the request. Its size, TTL and hit and miss
+            counters are set on the ``TTLCache``. Handler is called for every request if None
+            (default).
+        response_cache (ResponseCache): Cache of responses by ``messageId`` of the request,
+            answering redelivered events without handling them again. Every event is handled if
+            None (default).
+        state_cache (StateCache): Last known appliance states recorded from control and query
+            responses, read by ``Request.cached_response``. Not recorded if None (default).
+        codec (object): Codec from ``askhome.codec`` used by ``handle_bytes``. The fastest
+            installed JSON library is used if None (default).
+        token_validator (TokenValidator): Validates access tokens of all requests (except health
+            checks) before the prepare handler, responding with ``InvalidAccessTokenError`` or
+            ``ExpiredAccessTokenError``. Result of the validation is saved to
+            ``Request.token_info``. Tokens aren't validated if None (default).
+        deadline_margin (float): Seconds reserved for responding before the Lambda function
+            times out. When set, ``Request.deadline`` is computed from
+            ``context.get_remaining_time_in_millis()`` and actions still running at the deadline
+            are abandoned, responding with ``deadline_exception``. Synchronous actions then run
+            in a separate thread. Disabled if None (default).
+        deadline_exception (type): ``AskhomeException`` subclass responded with when an action
+            misses the deadline. Defaults to ``TargetOfflineError``.
 
     """
+    appliance_pool = None
+    discovery_cache = None
+    appliance_class_cache = None
+    response_cache = None
+    state_cache = None
+    codec = None
+    token_validator = None
+    deadline_margin = None
+    deadline_exception = TargetOfflineError
+    payload_log_level = logging.DEBUG
+    payload_log_indent = 2
+    payload_log_sample_rate = 1.0
+
     def __init__(self, **details):
         """
         Args:
             details (dict): Defaults for details of appliances during DiscoverAppliancesRequest.
                 See ``add_appliance`` method for possible values.
         """
-        self.appliances = {}
+        self._appliances = DictRegistry()
         self.details = details
+        self._discovery_payload = None
+        self._encoded_discovery = None  # (codec, discovery payload encoded by the codec)
+        self._discovery_version = None  # Version of the registry discovery payload was built from
+        self._rate_limits = {}  # Appliance id -> RateLimit overriding Appliance.rate_limit
         self._discover_func = None
         self._get_appliance_func = None
         self._healthcheck_func = None
         self._prepare_func = None
+        self._metrics_func = None
 
     def add_appliance(self, appl_id, appl_class, name=None, description=None,
                       additional_details=None, model=None, version=None, manufacturer=None,
-                      reachable=None):
+                      reachable=None, rate_limit=None):
         """Register ``Appliance`` so it can be discovered and routed to.
 
         The keyword arguments can be also defined in ``Smarthome.__init__`` and ``Details`` inner
@@ -53,31 +153,172 @@ class Smarthome(object):
             version (str): Vendor-provided version of the device. Cannot exceed 128 characters.
             manufacturer (str): Name of device manufacturer. Cannot exceed 128 characters.
             reachable (bool): Indicate if device is currently reachable.
+            rate_limit (RateLimit): Limit of requests to this appliance, overrides
+                ``Appliance.rate_limit``.
 
         """
         # The kwargs are explicitly named for better autocomplete
+        class_details = self._resolve_class_details(appl_class)
+        self.appliances.add(appl_id, appl_class, self._make_details(appl_id, class_details, {
+            'name': name,
+            'description': description,
+            'additional_details': additional_details,
+            'model': model,
+            'version': version,
+            'manufacturer': manufacturer,
+            'reachable': reachable,
+        }))
+        self._set_rate_limit(appl_id, rate_limit)
+        self._invalidate_discovery()
+
+    def add_appliances(self, appliances):
+        """Register many ``Appliance`` instances at once, same as calling ``add_appliance`` for
+        each of them.
+
+        Details defaults from ``Appliance.Details`` and ``Smarthome.__init__`` are resolved only
+        once per appliance class and appliances of the same class share the list of their actions.
+        Appliances are consumed one by one, so the argument can be a generator streaming rows from
+        a database.
+
+        Args:
+            appliances (iterable): Either dicts with keyword arguments of ``add_appliance`` or
+                tuples with its positional arguments, e.g. ``('light1', Light, 'Kitchen Light')``.
+
+        Raises:
+            TypeError: If an appliance has unknown arguments or lacks ``appl_id`` or
+                ``appl_class``, same as ``add_appliance`` would.
+
+        """
+        resolved = {}  # Appliance class -> (resolved defaults, actions)
+
+        def entries():
+            for appliance in appliances:
+                if isinstance(appliance, dict):
+                    kwargs = dict(appliance)
+                    unknown = set(kwargs).difference(_ADD_APPLIANCE_ARGS)
+                    if unknown:
+                        raise TypeError('Unknown add_appliance arguments %s in %r' % (
+                            ', '.join(sorted(unknown)), appliance))
+                else:
+                    if len(appliance) > len(_ADD_APPLIANCE_ARGS):
+                        raise TypeError('add_appliance takes at most %d arguments, got %r' % (
+                            len(_ADD_APPLIANCE_ARGS), appliance))
+                    kwargs = dict(zip(_ADD_APPLIANCE_ARGS, appliance))
+                if 'appl_id' not in kwargs or 'appl_class' not in kwargs:
+                    raise TypeError('Both appl_id and appl_class are required, got %r' % (
+                        appliance,))
+                appl_id = kwargs.pop('appl_id')
+                appl_class = kwargs.pop('appl_class')
+                self._set_rate_limit(appl_id, kwargs.pop('rate_limit', None))
+
+                class_details = resolved.get(appl_class)
+                if class_details is None:
+                    class_details = resolved[appl_class] = self._resolve_class_details(appl_class)
+
+                yield appl_id, appl_class, self._make_details(appl_id, class_details, kwargs)
 
-        # Helper function to get detail in hierarchy:
-        # Smarthome.add_appliance kwargs -> Appliance.Details -> Smarthome.__init__ kwargs
-        def get_detail(detail_name, arg, default=''):
-            if arg is not None:
-                return arg
-            if hasattr(appl_class, 'Details') and hasattr(appl_class.Details, detail_name):
-                return getattr(appl_class.Details, detail_name)
-            return self.details.get(detail_name, default)
+        try:
+            self.appliances.add_many(entries())
+        finally:
+            self._invalidate_discovery()
+
+    def _resolve_class_details(self, appl_class):
+        # Resolve details defaults in hierarchy: Appliance.Details -> Smarthome.__init__ kwargs
+        defaults = {}
+        class_defaults = getattr(appl_class, 'Details', None)
+        for arg, key, default in _DETAILS:
+            if class_defaults is not None and hasattr(class_defaults, arg):
+                defaults[arg] = getattr(class_defaults, arg)
+            else:
+                defaults[arg] = self.details.get(arg, default)
 
+        return defaults, FrozenList(sorted(appl_class.actions.keys()))  # sorted for easier testing
+
+    @staticmethod
+    def _make_details(appl_id, class_details, kwargs):
+        # Add add_appliance kwargs on top of resolved class details. Details are read-only, as
+        # discovery_payload shares them with every discovery response.
+        defaults, actions = class_details
         details = {
             'applianceId': appl_id,
-            'friendlyName': get_detail('name', name),
-            'friendlyDescription': get_detail('description', description, 'No description'),
-            'additionalApplianceDetails': get_detail('additional_details', additional_details, {}),
-            'modelName': get_detail('model', model,  'Unknown model'),
-            'version': get_detail('version', version, 'v1'),
-            'manufacturerName': get_detail('manufacturer', manufacturer, 'Unknown manufacturer'),
-            'isReachable': get_detail('reachable', reachable, True),
-            'actions': sorted(appl_class.actions.keys()),  # sorted for easier testing
+            'actions': actions,
         }
-        self.appliances[appl_id] = (appl_class, details)
+        for arg, key, _ in _DETAILS:
+            value = kwargs.get(arg)
+            details[key] = defaults[arg] if value is None else value
+        return _freeze_details(details)
+
+    def _set_rate_limit(self, appl_id, rate_limit):
+        if rate_limit is None:
+            self._rate_limits.pop(appl_id, None)
+        else:
+            self._rate_limits[appl_id] = rate_limit
+
+    def remove_appliance(self, appl_id):
+        """Unregister previously added ``Appliance``, so it's no longer discovered or routed to.
+
+        Args:
+            appl_id (str): Identifier the appliance was added with.
+
+        Raises:
+            KeyError: If no appliance was added with that identifier.
+
+        """
+        self.appliances.remove(appl_id)
+        self._rate_limits.pop(appl_id, None)
+        self._invalidate_discovery()
+
+    @property
+    def appliances(self):
+        """ApplianceRegistry: All registered appliances as ``(Appliance, dict)`` tuples with
+        their details, keyed by appliance id. In-memory ``DictRegistry`` by default, assign a
+        different registry (like ``SQLiteRegistry``) to load appliances only when requested.
+        """
+        return self._appliances
+
+    @appliances.setter
+    def appliances(self, registry):
+        if not isinstance(registry, ApplianceRegistry):
+            registry = DictRegistry(registry)
+        self._appliances = registry
+        self._invalidate_discovery()
+
+    def _invalidate_discovery(self):
+        self._discovery_payload = None
+        self._encoded_discovery = None
+
+    @property
+    def discovery_payload(self):
+        """dict: Payload of the DiscoverAppliancesResponse with all registered appliances.
+
+        The payload is built once and shared by all discovery responses until an appliance is
+        added or removed, so it's read-only all the way down. Changes made to a registry other
+        than ``DictRegistry`` directly instead of through ``add_appliance`` and
+        ``remove_appliance`` are not picked up.
+        """
+        version = getattr(self.appliances, 'version', None)
+        if self._discovery_payload is None or version != self._discovery_version:
+            self._invalidate_discovery()
+            discovered = FrozenList(_freeze_details(details)
+                                    for appl, details in self.appliances.values())
+            self._discovery_payload = FrozenDict({'discoveredAppliances': discovered})
+            self._discovery_version = version
+        return self._discovery_payload
+
+    def freeze(self):
+        """Prepare the ``Smarthome`` for being shared with forked worker processes.
+
+        Builds ``discovery_payload`` and its encoding used by ``handle_bytes``, then collects
+        garbage and moves all remaining objects to a permanent generation ignored by the garbage
+        collector (``gc.freeze``, Python 3.7+). Workers forked afterwards don't write to the pages
+        holding the appliances when collecting, so the pages stay shared with the parent. Adding
+        or removing appliances later works, but the workers then have their own copies.
+        """
+        codec = self._get_codec()
+        self._encoded_discovery = (codec, codec.dumps(self.discovery_payload))
+        gc.collect()
+        if hasattr(gc, 'freeze'):
+            gc.freeze()
 
     def prepare_handler(self, func):
         """Decorator for a function that gets called before every request. Useful to modify the
@@ -90,7 +331,8 @@ class Smarthome(object):
         """Decorator for a function that handles the DiscoverAppliancesRequest instead of the
         ``Smarthome``. This can be useful for situations where querying the list of all devices
         is too expensive to be done every request. Should be used in conjunction with the
-        ``get_appliance_handler`` decorator.
+        ``get_appliance_handler`` decorator. Responses can be cached per user by setting
+        ``discovery_cache``.
         """
         self._discover_func = func
         return func
@@ -98,6 +340,7 @@ class Smarthome(object):
     def get_appliance_handler(self, func):
         """Decorator for a function that handles getting the ``Appliance`` subclass instead of the
         ``Smarthome``. Should be used in conjunction with the ``get_appliance_handler`` decorator.
+        Results can be cached by setting ``appliance_class_cache``.
         """
         self._get_appliance_func = func
         return func
@@ -109,59 +352,395 @@ class Smarthome(object):
         self._healthcheck_func = func
         return func
 
+    def metrics_handler(self, func):
+        """Decorator for a function receiving durations of request handling stages, useful to
+        find out whether latency comes from askhome or the appliance backends.
+
+        The function is called as ``func(stage, duration, request_name, appliance_cls)`` with
+        duration in seconds and ``appliance_cls`` being None until the appliance is found.
+        Stages are reported in this order, skipping those that don't apply to the request:
+
+            * parse: Creating ``Request`` from the event
+            * auth: Validating the access token with ``token_validator``
+            * prepare: ``prepare_handler``
+            * lookup: Finding the ``Appliance`` subclass and its action
+            * construct: Creating (or reusing from ``appliance_pool``) the appliance instance
+            * action: The action method, or the discover and health check handlers
+            * response: Building the response
+            * error: Everything since the last reported stage when an ``AskhomeException``
+              was raised, including building the error response
+
+        Stages aren't timed at all when no function is set.
+        """
+        self._metrics_func = func
+        return func
+
     def lambda_handler(self, data, context=None):
-        """Main entry point for handling requests. Pass the AWS Lambda events here."""
-        logger.debug(json.dumps(data, indent=2))
+        """Main entry point for handling requests. Pass the AWS Lambda events here.
+
+        Raises:
+            TypeError: If an action or handler is a coroutine function, use
+                ``async_lambda_handler`` for those.
+
+        """
+        log_payloads = self._should_log_payloads()
+        if log_payloads:
+            self._log_payload(data)
 
         response = self._lambda_handler(data, context)
-        logger.debug(json.dumps(response, indent=2))
+        if log_payloads:
+            self._log_payload(response)
 
         return response
 
+    def handle_bytes(self, raw, context=None):
+        """Entry point for handling requests as raw JSON, for running outside of AWS Lambda.
+
+        Decoding and encoding is done by ``codec``. The cached ``discovery_payload`` is encoded
+        only once and spliced into every discovery response.
+
+        Args:
+            raw (bytes): Event encoded as JSON.
+            context (object): Context object passed to the request.
+
+        Returns:
+            bytes: Response encoded as JSON.
+
+        """
+        return self.encode_response(self.lambda_handler(self.decode_event(raw), context))
+
+    def decode_event(self, raw):
+        """Decode event from raw JSON with ``codec``, the first half of ``handle_bytes``.
+
+        Raises:
+            ValueError: If the event isn't valid JSON.
+
+        """
+        return self._get_codec().loads(raw)
+
+    def encode_response(self, response):
+        """Encode response to raw JSON with ``codec``, the second half of ``handle_bytes``. The
+        cached ``discovery_payload`` is encoded only once.
+        """
+        codec = self._get_codec()
+        payload = self._discovery_payload
+        if payload is None or response.get('payload') is not payload:
+            return codec.dumps(response)
+
+        encoded = self._encoded_discovery
+        if encoded is None or encoded[0] is not codec:
+            encoded = self._encoded_discovery = (codec, codec.dumps(payload))
+        return b''.join((b'{"header":', codec.dumps(response['header']),
+                         b',"payload":', encoded[1], b'}'))
+
+    def _get_codec(self):
+        if self.codec is None:
+            return default_codec()
+        return self.codec
+
+    def handle_batch(self, events, context=None, max_workers=8):
+        """Handle multiple events concurrently in a thread pool.
+
+        Events for the same appliance are handled one after another in their original order,
+        events for different appliances (and events without an appliance, like discovery) run
+        concurrently.
+
+        Args:
+            events (list(dict)): Events in the same format as passed to ``lambda_handler``.
+            context (object): Context object passed to all requests.
+            max_workers (int): Maximum number of threads handling the events.
+
+        Returns:
+            list(dict): Responses in the same order as the events. Exceptions not derived from
+            ``AskhomeException`` are isolated to their event and answered with the
+            ``DriverInternalError`` response. Events that can't be parsed into a ``Request`` get
+            ``None`` instead of a response.
+
+        """
+        # Group event indexes by appliance, events without one get a group of their own
+        groups = OrderedDict()
+        for index, event in enumerate(events):
+            appliance = event.get('payload', {}).get('appliance', {})
+            key = appliance.get('applianceId', (None, index))
+            groups.setdefault(key, []).append(index)
+
+        responses = [None] * len(events)
+
+        def handle_group(indexes):
+            for index in indexes:
+                responses[index] = self._handle_isolated(events[index], context)
+
+        if groups:
+            map_in_threads(handle_group, list(groups.values()), min(max_workers, len(groups)))
+
+        return responses
+
+    def _handle_isolated(self, data, context=None):
+        try:
+            return self.lambda_handler(data, context)
+        except Exception:
+            logger.exception('Unhandled exception while handling event')
+            try:
+                request = create_request(data, context)
+            except Exception:
+                return None
+            return request.exception_response(DriverInternalError())
+
+    @staticmethod
+    def _log_exception(exception, response):
+        # Has to be called from the except block for the traceback to be logged
+        policy = exception.log_policy
+        if policy == 'none' or not logger.isEnabledFor(logging.INFO):
+            return
+        if policy == 'summary':
+            logger.info('Exception raised: %r, %s', exception, response)
+            return
+        if policy != 'traceback':
+            if not isinstance(policy, numbers.Real):
+                # Typo in the policy shouldn't hide the exception, fall back to the default
+                logger.warning('Unknown log_policy %r of %s, logging with traceback', policy,
+                               type(exception).__name__)
+            elif random.random() >= policy:
+                return
+        logger.info('Exception raised: %r, %s', exception, response, exc_info=True)
+
+    def _should_log_payloads(self):
+        # Decide once per request, so that both request and response are logged or neither is
+        if not logger.isEnabledFor(self.payload_log_level):
+            return False
+        return self.payload_log_sample_rate >= 1 or random.random() < self.payload_log_sample_rate
+
+    def _log_payload(self, payload):
+        logger.log(self.payload_log_level, '%s', LazyJson(payload, self.payload_log_indent))
+
     def _lambda_handler(self, data, context=None):
         # This method is here just so it can be wrapped for logging
+        if self.response_cache is not None:
+            return self._deduplicate(data, context)
+        return self._handle_event(data, context)
+
+    def _deduplicate(self, data, context):
+        # Answer duplicates of already handled events from the response cache
+        cache = self.response_cache
+        key = cache.key(data)
+        response, in_flight = cache.acquire(key)
+        if response is not None:
+            return response
+        if in_flight is not None:
+            response = cache.wait(in_flight)
+            return self._handle_event(data, context) if response is None else response
+
+        try:
+            response = self._handle_event(data, context)
+        finally:
+            cache.release(key, response)
+        return response
 
+    def _handle_event(self, data, context=None):
+        request, stopwatch = self._create_request(data, context)
+
+        routing = self._route(request, stopwatch)
+        try:
+            call = next(routing)
+            while isinstance(call, HandlerCall):
+                try:
+                    if call.timeout is None:
+                        result = call.func(*call.args)
+                    elif call.timeout <= 0:
+                        raise self.deadline_exception()
+                    else:
+                        finished, result = call_with_timeout(call.run, (), call.timeout)
+                        if not finished:
+                            call.abandon()
+                            raise self.deadline_exception()
+                except AskhomeException as exception:
+                    if sys.version_info[0] < 3:
+                        # Pass the traceback along too, Python 2 exceptions don't carry it
+                        call = routing.throw(*sys.exc_info())
+                    else:
+                        call = routing.throw(exception)
+                else:
+                    if hasattr(result, '__await__'):
+                        self._reject_awaitable(call.func, result)
+                    call = routing.send(result)
+        finally:
+            # Also lets routing clean up when a handler raises an unexpected exception
+            routing.close()
+        return call
+
+    @staticmethod
+    def _reject_awaitable(func, result):
+        # Coroutine functions can't be run by the synchronous handler
+        if hasattr(result, 'close'):
+            result.close()  # Prevent the "never awaited" warning
+        raise TypeError('%s returned an awaitable, use async_lambda_handler to handle requests '
+                        'with coroutine functions' % getattr(func, '__name__', func))
+
+    def _create_request(self, data, context):
+        # Create request and stopwatch timing its stages if there's a metrics handler
+        if self._metrics_func is None:
+            return create_request(data, context), None
+
+        stopwatch = Stopwatch(self._metrics_func)
         request = create_request(data, context)
+        stopwatch.request_name = request.name
+        stopwatch.lap('parse')
+        return request, stopwatch
+
+    def _route(self, request, stopwatch=None):
+        """Generator routing the request to handlers and appliance actions.
+
+        Calls of user code are yielded as ``HandlerCall`` and their results are sent back in, so
+        the same routing can be driven synchronously by ``lambda_handler`` as well as with
+        coroutines awaited by ``async_lambda_handler``. The last yielded value is the response.
+        """
+        if self.state_cache is not None:
+            request.state_cache = self.state_cache
+        if self.deadline_margin is not None:
+            get_remaining_time = getattr(request.context, 'get_remaining_time_in_millis', None)
+            if get_remaining_time is not None:
+                remaining = get_remaining_time() / 1000.0 - self.deadline_margin
+                request.deadline = monotonic() + remaining
 
         try:
+            # Validate access token, calling the validator function only if it isn't cached
+            validator = self.token_validator
+            if validator is not None and request.name != 'HealthCheckRequest':
+                token = request.access_token
+                info = validator.get(token)
+                if info is None:
+                    try:
+                        info = yield HandlerCall(validator.func, token)
+                    except (InvalidAccessTokenError, ExpiredAccessTokenError) as exception:
+                        validator.set_error(token, exception)
+                    info = validator.set(token, info)
+                request.token_info = info
+                if stopwatch is not None:
+                    stopwatch.lap('auth')
+
             # Handle prepare request
             if self._prepare_func is not None:
-                self._prepare_func(request)
+                yield HandlerCall(self._prepare_func, request)
+                if stopwatch is not None:
+                    stopwatch.lap('prepare')
 
             # Handle discover request
             if request.name == 'DiscoverAppliancesRequest':
                 if self._discover_func is None:
-                    return request.response(self)
-                return self._discover_func(request)
+                    response = request.response(self)
+                    stage = 'response'
+                elif self.discovery_cache is None:
+                    response = yield HandlerCall(self._discover_func, request)
+                    stage = 'action'
+                else:
+                    cache = self.discovery_cache
+                    key = cache.key(request)
+                    payload, stale = cache.get(key)
+                    if payload is None:
+                        response = yield HandlerCall(self._discover_func, request)
+                        cache.set(key, response)
+                        stage = 'action'
+                    else:
+                        response = request.raw_response(payload)
+                        if stale:
+                            cache.refresh(key, self._discover_func, request)
+                        stage = 'response'
 
             # Handle health check
-            if request.name == "HealthCheckRequest":
+            elif request.name == "HealthCheckRequest":
                 if self._healthcheck_func is None:
-                    return request.response(healthy=True, description="Everything's OK")
-                return self._healthcheck_func(request)
-
-            # Find the according appliance
-            if self._get_appliance_func is None:
-                # Appliance not found - return error response
-                if request.appliance_id not in self.appliances:
-                    raise UnsupportedTargetError
-                appliance_cls = self.appliances[request.appliance_id][0]
+                    response = request.response(healthy=True, description="Everything's OK")
+                    stage = 'response'
+                else:
+                    response = yield HandlerCall(self._healthcheck_func, request)
+                    stage = 'action'
+
             else:
-                appliance_cls = self._get_appliance_func(request)
+                # Find the according appliance
+                if self._get_appliance_func is None:
+                    # Appliance not found - return error response
+                    entry = self.appliances.get(request.appliance_id)
+                    if entry is None:
+                        raise UnsupportedTargetError
+                    appliance_cls = entry[0]
+                elif self.appliance_class_cache is None:
+                    appliance_cls = yield HandlerCall(self._get_appliance_func, request)
+                else:
+                    key = (request.appliance_id,
+                           json.dumps(request.appliance_details, sort_keys=True))
+                    appliance_cls = self.appliance_class_cache.get(key)
+                    if appliance_cls is None:
+                        appliance_cls = yield HandlerCall(self._get_appliance_func, request)
+                        self.appliance_class_cache.set(key, appliance_cls)
 
-            # Appliance doesn't handle requested operation - return error response
-            if request.name not in appliance_cls.request_handlers:
-                raise UnsupportedOperationError
+                # Appliance doesn't handle requested operation - return error response
+                handler = appliance_cls.request_handlers.get(request.name)
+                if handler is None:
+                    raise UnsupportedOperationError
 
-            # Finally instantiate the appliance and call the requested method
-            appliance = appliance_cls(request)
-            response = appliance_cls.request_handlers[request.name](appliance, request)
+                # Check rate limits before doing any work for the request
+                rate_limit = self._rate_limits.get(request.appliance_id) or appliance_cls.rate_limit
+                if rate_limit is not None and not rate_limit.acquire(request.appliance_id):
+                    raise rate_limit.exception()
+                rate_limit = appliance_cls.class_rate_limit
+                if rate_limit is not None and not rate_limit.acquire(appliance_cls):
+                    raise rate_limit.exception()
 
-            if response is None:
-                return request.response()
-            return response
+                if stopwatch is not None:
+                    stopwatch.appliance_cls = appliance_cls
+                    stopwatch.lap('lookup')
+
+                breaker = appliance_cls.circuit_breaker
+                if breaker is not None:
+                    breaker.before_call()
+
+                pool = self.appliance_pool
+                appliance = call = None
+                broken = True  # Unless the action returned or raised AskhomeException
+                try:
+                    # Finally instantiate the appliance and call the requested method
+                    if pool is None:
+                        appliance = appliance_cls(request)
+                    else:
+                        appliance = pool.get(appliance_cls, request)
+                    if stopwatch is not None:
+                        stopwatch.lap('construct')
+
+                    call = HandlerCall(handler, appliance, request)
+                    if request.deadline is not None:
+                        call.timeout = request.remaining_time
+                        if pool is not None:
+                            call.on_abandoned = partial(pool.discard, appliance)
+                    response = yield call
+                    broken = False
+                    if stopwatch is not None:
+                        stopwatch.lap('action')
+                except AskhomeException as exception:
+                    broken = False
+                    if breaker is not None:
+                        breaker.record_failure(exception)
+                    raise
+                finally:
+                    # Instances of abandoned actions are discarded by on_abandoned
+                    abandoned = call is not None and call.abandoned
+                    if pool is not None and appliance is not None and not abandoned:
+                        if broken:
+                            pool.discard(appliance)
+                        else:
+                            pool.release(appliance_cls, request, appliance)
+                if breaker is not None:
+                    breaker.record_success()
+
+                stage = 'response'
+                if response is None:
+                    response = request.response()
 
         except AskhomeException as exception:
             response = request.exception_response(exception)
-            logger.info('Exception raised: %r, %s', exception, response, exc_info=True)
-            return response
+            stage = 'error'
+            self._log_exception(exception, response)
+
+        if stopwatch is not None:
+            stopwatch.lap(stage)
+
+        yield response
@@ -1,5 +1,14 @@
+import json
+import sys
+import threading
+import time
+from timeit import default_timer
+
 import inflection
 
+# Clock for measuring time intervals, not affected by system clock updates where available
+monotonic = getattr(time, 'monotonic', time.time)
+
 
 def get_action_string(func_name):
     """Transform function name to Alexa action"""
@@ -16,3 +25,223 @@ def rstrip_word(text, suffix):
     if not text.endswith(suffix):
         return text
     return text[:len(text)-len(suffix)]
+
+
+def with_metaclass(meta, *bases):
+    """Create a base class with a metaclass, works the same on Python 2 and 3"""
+    return meta('_MetaBase', bases or (object,), {'__slots__': ()})
+
+
+def call_blocking(func, *args):
+    """Call function and return its result, running it to completion in a new event loop if it's
+    awaitable. Useful for calling handlers that can be coroutine functions outside of asyncio.
+    """
+    result = func(*args)
+    if hasattr(result, '__await__'):
+        import asyncio
+        loop = asyncio.new_event_loop()
+        try:
+            result = loop.run_until_complete(result)
+        finally:
+            loop.close()
+    return result
+
+
+if sys.version_info[0] >= 3:
+    def reraise(exc_type, value, traceback):
+        """Raise exception with the traceback it was originally raised with."""
+        raise value.with_traceback(traceback)
+else:
+    # Python 2 syntax for raising with traceback doesn't even compile on Python 3
+    exec('def reraise(exc_type, value, traceback):\n'
+         '    """Raise exception with the traceback it was originally raised with."""\n'
+         '    raise exc_type, value, traceback\n')
+
+
+def call_with_timeout(func, args, timeout):
+    """Call function in a daemon thread and wait for it at most timeout seconds.
+
+    The function keeps running in the background after the timeout, there is no way to stop it.
+
+    Returns:
+        (bool, Any): Whether the function finished in time and its result.
+
+    """
+    outcome = []
+
+    def target():
+        try:
+            outcome.append((True, func(*args)))
+        except BaseException:
+            outcome.append((False, sys.exc_info()))
+
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+    thread.join(timeout)
+    if not outcome:
+        return False, None
+
+    succeeded, result = outcome[0]
+    if not succeeded:
+        reraise(*result)
+    return True, result
+
+
+# Pools from multiprocessing need semaphores in /dev/shm, which AWS Lambda doesn't have
+if sys.version_info[0] >= 3:
+    from concurrent.futures import ThreadPoolExecutor
+
+    def map_in_threads(func, items, max_workers):
+        """Call function with every item in at most max_workers threads and wait for all of
+        them. The first exception raised by the function is re-raised.
+        """
+        with ThreadPoolExecutor(max_workers) as executor:
+            for _ in executor.map(func, items):
+                pass
+else:
+    import Queue as queue
+
+    def map_in_threads(func, items, max_workers):
+        """Call function with every item in at most max_workers threads and wait for all of
+        them. The first exception raised by the function is re-raised.
+        """
+        pending = queue.Queue()
+        for item in items:
+            pending.put(item)
+        errors = []
+
+        def worker():
+            while True:
+                try:
+                    item = pending.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    func(item)
+                except BaseException:
+                    errors.append(sys.exc_info())
+
+        threads = [threading.Thread(target=worker) for _ in range(min(max_workers, len(items)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            reraise(*errors[0])
+
+
+class FrozenDict(dict):
+    """Read-only dict. Still a dict subclass, so it serializes to JSON and compares equal to
+    regular dicts.
+    """
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('%s is read-only' % type(self).__name__)
+
+    __setitem__ = __delitem__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __reduce__(self):
+        return type(self), (dict(self),)
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, dict.__repr__(self))
+
+
+class FrozenList(list):
+    """Read-only list. Still a list subclass, so it serializes to JSON and compares equal to
+    regular lists.
+    """
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('%s is read-only' % type(self).__name__)
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = __setslice__ = __delslice__ = _readonly
+    append = extend = insert = pop = remove = reverse = sort = clear = _readonly
+
+    def __reduce__(self):
+        return type(self), (list(self),)
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, list.__repr__(self))
+
+
+class LazyJson(object):
+    """Wrapper that serializes the object to JSON only when converted to string. Pass it as a
+    logging argument so the serialization is skipped for messages that aren't emitted.
+    """
+    __slots__ = ('obj', 'indent')
+
+    def __init__(self, obj, indent=None):
+        self.obj = obj
+        self.indent = indent
+
+    def __str__(self):
+        if self.indent is None:
+            return json.dumps(self.obj, separators=(',', ':'))
+        return json.dumps(self.obj, indent=self.indent)
+
+
+# Guards the running and abandoned state of all handler calls, held only for a few instructions
+_call_lock = threading.Lock()
+
+
+class HandlerCall(object):
+    """Call of a user defined handler or action, yielded by ``Smarthome`` routing so that its
+    caller decides how to run it. Calls with ``timeout`` (seconds) set are abandoned after it:
+    the caller runs ``run`` in another thread and calls ``abandon`` when the time is up.
+    ``on_abandoned`` is then called once the function isn't running anymore.
+    """
+    __slots__ = ('func', 'args', 'timeout', 'abandoned', 'on_abandoned', '_running')
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+        self.timeout = None
+        self.abandoned = False
+        self.on_abandoned = None
+        self._running = False
+
+    def run(self):
+        """Call the function unless the call was abandoned before it started, use it in place of
+        ``func`` when running the call in another thread.
+        """
+        with _call_lock:
+            if self.abandoned:
+                return None
+            self._running = True
+        try:
+            return self.func(*self.args)
+        finally:
+            with _call_lock:
+                self._running = False
+                finished_late = self.abandoned
+            if finished_late and self.on_abandoned is not None:
+                self.on_abandoned()
+
+    def abandon(self):
+        """Mark the call as abandoned and call ``on_abandoned`` unless the function is running,
+        ``run`` calls it when the function finishes otherwise.
+        """
+        with _call_lock:
+            self.abandoned = True
+            running = self._running
+        if not running and self.on_abandoned is not None:
+            self.on_abandoned()
+
+
+class Stopwatch(object):
+    """Measures consecutive stages of handling a request and reports them to a metrics function.
+    """
+    __slots__ = ('func', 'request_name', 'appliance_cls', 'last')
+
+    def __init__(self, func, request_name=None, appliance_cls=None):
+        self.func = func
+        self.request_name = request_name
+        self.appliance_cls = appliance_cls
+        self.last = default_timer()
+
+    def lap(self, stage):
+        """Report time since the previous lap (or creation) as duration of stage."""
+        now = default_timer()
+        self.func(stage, now - self.last, self.request_name, self.appliance_cls)
+        self.last = now
@@ -1,3 +1,5 @@
+import sys
+
 import pytest
 
 from askhome import Appliance
@@ -18,6 +20,58 @@ def discover_request():
     }
 
 
+def _control_request(name, appliance_id, message_id='01ebf625-0b89-4c4d-b3aa-32340e894688'):
+    return {
+        'header': {
+            'messageId': message_id,
+            'name': name,
+            'namespace': 'Alexa.ConnectedHome.Control',
+            'payloadVersion': '2'
+        },
+        'payload': {
+            'accessToken': '[OAuth token here]',
+            'appliance': {
+                'additionalApplianceDetails': {},
+                'applianceId': appliance_id
+            }
+        }
+    }
+
+
+@pytest.fixture(scope='module')
+def control_request():
+    """Function building events, e.g. ``control_request('TurnOnRequest', 'light1')``."""
+    return _control_request
+
+
+class Clock(object):
+    def __init__(self):
+        self.time = 0.0
+
+    def __call__(self):
+        return self.time
+
+
+@pytest.fixture
+def clock():
+    """Clock for the ``clock`` arguments, move it by setting its ``time``."""
+    return Clock()
+
+
+class LambdaContext(object):
+    def __init__(self, remaining_millis):
+        self.remaining_millis = remaining_millis
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_millis
+
+
+@pytest.fixture(scope='module')
+def lambda_context():
+    """AWS Lambda context class, takes the remaining time in milliseconds."""
+    return LambdaContext
+
+
 @pytest.fixture(scope='module')
 def Light():
     class Light2(Appliance):
@@ -26,3 +80,11 @@ def Light():
             pass
 
     return Light2
+
+
+# Tests using the async syntax can't even be collected on older Pythons
+collect_ignore = []
+if sys.version_info < (3, 5):
+    collect_ignore.append('test_aio.py')
+if sys.version_info < (3, 7):
+    collect_ignore.append('test_server.py')
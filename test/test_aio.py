@@ -0,0 +1,139 @@
+import asyncio
+
+import pytest
+
+from askhome import Smarthome, Appliance, ResponseCache
+from askhome.exceptions import TargetOfflineError
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+@pytest.fixture
+def turn_on_request(control_request):
+    return control_request('TurnOnRequest', 'light1')
+
+
+def test_async_action(turn_on_request):
+    class Light(Appliance):
+        @Appliance.action
+        async def turn_on(self, request):
+            await asyncio.sleep(0)
+            return request.raw_response({'foo': request.custom_data})
+
+        @Appliance.action
+        def turn_off(self, request):
+            pass
+
+    home = Smarthome()
+    home.add_appliance('light1', Light)
+
+    @home.prepare_handler
+    async def prepare(request):
+        request.custom_data = 'bar'
+
+    response = run(home.async_lambda_handler(turn_on_request))
+    assert response['header']['name'] == 'TurnOnConfirmation'
+    assert response['payload'] == {'foo': 'bar'}
+
+    # Sync actions work as well
+    turn_on_request['header']['name'] = 'TurnOffRequest'
+    response = run(home.async_lambda_handler(turn_on_request))
+    assert response['header']['name'] == 'TurnOffConfirmation'
+    assert response['payload'] == {}
+
+
+def test_async_handlers(turn_on_request, discover_request, Light):
+    home = Smarthome()
+
+    @home.get_appliance_handler
+    async def get_appliance(request):
+        return Light
+
+    @home.discover_handler
+    async def discover(request):
+        home.add_appliance('light1', Light)
+        return request.response(home)
+
+    response = run(home.async_lambda_handler(discover_request))
+    assert response['payload']['discoveredAppliances'][0]['applianceId'] == 'light1'
+
+    response = run(home.async_lambda_handler(turn_on_request))
+    assert response['header']['name'] == 'TurnOnConfirmation'
+
+
+def test_async_exception(turn_on_request):
+    class Light(Appliance):
+        @Appliance.action
+        async def turn_on(self, request):
+            raise TargetOfflineError
+
+    home = Smarthome()
+    home.add_appliance('light1', Light)
+
+    response = run(home.async_lambda_handler(turn_on_request))
+    assert response['header']['name'] == 'TargetOfflineError'
+
+    turn_on_request['payload']['appliance']['applianceId'] = 'light2'
+    response = run(home.async_lambda_handler(turn_on_request))
+    assert response['header']['name'] == 'UnsupportedTargetError'
+
+
+def test_async_response_cache(turn_on_request):
+    calls = []
+
+    class Light(Appliance):
+        @Appliance.action
+        async def turn_on(self, request):
+            calls.append(request)
+            await asyncio.sleep(0.05)
+
+    home = Smarthome()
+    home.response_cache = ResponseCache()
+    home.add_appliance('light1', Light)
+
+    async def handle_twice():
+        return await asyncio.gather(home.async_lambda_handler(turn_on_request),
+                                    home.async_lambda_handler(turn_on_request))
+
+    first, duplicate = run(handle_twice())
+    assert duplicate is first
+    assert len(calls) == 1
+
+
+class LambdaContext(object):
+    def get_remaining_time_in_millis(self):
+        return 300
+
+
+def test_async_deadline(turn_on_request):
+    class Light(Appliance):
+        @Appliance.action
+        async def turn_on(self, request):
+            await asyncio.sleep(1)
+
+    home = Smarthome()
+    home.deadline_margin = 0.1
+    home.add_appliance('light1', Light)
+
+    response = run(home.async_lambda_handler(turn_on_request, LambdaContext()))
+    assert response['header']['name'] == 'TargetOfflineError'
+
+
+def test_coroutine_action_in_sync_handler(turn_on_request):
+    class Light(Appliance):
+        @Appliance.action
+        async def turn_on(self, request):
+            pass
+
+    home = Smarthome()
+    home.add_appliance('light1', Light)
+
+    with pytest.raises(TypeError) as excinfo:
+        home.lambda_handler(turn_on_request)
+    assert 'async_lambda_handler' in str(excinfo.value)
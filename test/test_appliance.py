@@ -1,3 +1,5 @@
+import pytest
+
 from askhome import Appliance, create_request
 
 
@@ -87,3 +89,39 @@ def test_inherited_actions():
 
 def test_appliance_docstrings():
     assert isinstance(Appliance.actions.__doc__, str)
+
+
+def test_action_tables_cached():
+    class Light(Appliance):
+        @Appliance.action
+        def turn_on(self, request):
+            return 1
+
+    # Tables are built once and not recomputed on every access
+    assert Light.request_handlers is Light.request_handlers
+    assert Light.actions is Light.actions
+
+    with pytest.raises(TypeError):
+        Light.actions['turnOff'] = None
+
+
+def test_action_tables_invalidated():
+    class Light(Appliance):
+        @Appliance.action
+        def turn_on(self, request):
+            return 1
+
+    class Light2(Light):
+        pass
+
+    @Appliance.action
+    def turn_off(self, request):
+        return 2
+
+    Light.turn_off = turn_off
+    assert sorted(Light.actions) == ['turnOff', 'turnOn']
+    # Subclasses get their tables rebuilt as well
+    assert sorted(Light2.request_handlers) == ['TurnOffRequest', 'TurnOnRequest']
+
+    del Light.turn_off
+    assert sorted(Light2.actions) == ['turnOn']
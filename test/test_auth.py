@@ -0,0 +1,46 @@
+import pytest
+
+from askhome.auth import TokenValidator
+from askhome.exceptions import ExpiredAccessTokenError, InvalidAccessTokenError
+
+
+def test_token_validator(clock):
+    calls = []
+
+    def introspect(token):
+        calls.append(token)
+        if token == 'raises':
+            raise ExpiredAccessTokenError
+        return {
+            'valid': {'active': True, 'sub': 'user1', 'exp': 1000 + 100},
+            'expired': {'active': True, 'exp': 1000 - 1},
+            'inactive': {'active': False},
+        }.get(token)
+
+    validator = TokenValidator(introspect, ttl=300, negative_ttl=10, clock=clock,
+                               time_func=lambda: 1000 + clock.time)
+
+    assert validator.validate('valid')['sub'] == 'user1'
+    assert validator.validate('valid')['sub'] == 'user1'
+    assert calls == ['valid']
+
+    for token, error in [('expired', ExpiredAccessTokenError),
+                         ('inactive', InvalidAccessTokenError),
+                         ('unknown', InvalidAccessTokenError),
+                         ('raises', ExpiredAccessTokenError)]:
+        # Negative results are cached too
+        for _ in range(2):
+            with pytest.raises(error):
+                validator.validate(token)
+        assert calls.count(token) == 1
+
+    with pytest.raises(InvalidAccessTokenError):
+        validator.validate(None)
+
+    # Valid token is cached only until its expiration
+    clock.time = 99
+    validator.validate('valid')
+    clock.time = 100
+    with pytest.raises(ExpiredAccessTokenError):
+        validator.validate('valid')
+    assert calls.count('valid') == 2
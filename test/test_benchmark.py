@@ -0,0 +1,26 @@
+from askhome import benchmark
+
+
+def test_benchmark_scenarios():
+    # Every scenario has to produce a response of the expected type
+    for name, func in benchmark.scenarios(appliances=3):
+        response = func()
+        if name.startswith('error'):
+            assert response['header']['name'].endswith('Error')
+        elif name != 'parse request':
+            assert not response['header']['name'].endswith('Error'), name
+
+
+def test_benchmark_compare(tmpdir):
+    results = benchmark.run(number=5, appliances=3, name_filter='turn on')
+    assert list(results) == ['turn on']
+    assert set(['ops', 'p50', 'p99']) <= set(results['turn on'])
+
+    baseline = {'turn on': {'ops': results['turn on']['ops'] * 2}}
+    assert benchmark.compare(results, baseline, threshold=0.1) == ['turn on']
+    assert benchmark.compare(results, baseline, threshold=0.6) == []
+
+    path = str(tmpdir.join('baseline.json'))
+    assert benchmark.main(['-n', '5', '-a', '3', '-k', 'discover', '--save', path]) == 0
+    assert benchmark.main(['-n', '5', '-a', '3', '-k', 'discover', '--compare', path,
+                           '--threshold', '1']) == 0
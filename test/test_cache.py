@@ -0,0 +1,164 @@
+import copy
+import threading
+import time
+from datetime import datetime
+
+from askhome import Smarthome, DiscoveryCache, ResponseCache, StateCache
+from askhome.cache import TTLCache
+
+
+def test_ttl_cache_lru():
+    evicted = []
+    cache = TTLCache(2, on_evict=lambda key, value: evicted.append(key))
+
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)  # Evicts the least recently used 'b'
+
+    assert evicted == ['b']
+    assert cache.get('b') is None
+    assert cache.get('c') == 3
+    assert len(cache) == 2
+    assert (cache.hits, cache.misses) == (2, 1)
+
+    cache.set('a', 4)  # Replaced values are evicted too
+    assert cache.pop('c') == 3
+    assert cache.pop('c', 'default') == 'default'
+    cache.clear()
+    assert evicted == ['b', 'a', 'c', 'a']
+    assert len(cache) == 0
+
+
+def test_ttl_cache_expiration(clock):
+    evicted = []
+    cache = TTLCache(10, ttl=5, on_evict=lambda key, value: evicted.append(key), clock=clock)
+
+    cache.set('a', 1)
+    cache.set('b', 2, ttl=20)
+    clock.time = 4.9
+    assert cache.get('a') == 1
+
+    clock.time = 5
+    assert cache.get('a', 'default') == 'default'
+    assert cache.get('b') == 2
+    assert evicted == ['a']
+
+    # Taken values are removed without eviction, expired ones are evicted
+    assert cache.take('b') == 2
+    assert len(cache) == 0
+    cache.set('c', 3)
+    clock.time = 10
+    assert cache.take('c', 'default') == 'default'
+    assert evicted == ['a', 'c']
+
+
+def test_discovery_cache(discover_request, Light, clock):
+    home = Smarthome()
+    home.discovery_cache = DiscoveryCache(ttl=10, stale_ttl=10, clock=clock)
+    calls = []
+    refreshed = threading.Event()
+
+    @home.discover_handler
+    def discover(request):
+        calls.append(request.access_token)
+        home.add_appliance(str(len(calls)), Light)
+        refreshed.set()
+        return request.response(home)
+
+    def discovered_ids(request=discover_request):
+        response = home.lambda_handler(request)
+        assert response['header']['messageId'] == request['header']['messageId']
+        return sorted(appl['applianceId']
+                      for appl in response['payload']['discoveredAppliances'])
+
+    assert discovered_ids() == ['1']
+    clock.time = 9
+    assert discovered_ids() == ['1']
+    assert calls == ['OAuth Token']
+
+    # Other users have their own entry
+    other_request = copy.deepcopy(discover_request)
+    other_request['payload']['accessToken'] = 'Other Token'
+    other_request['header']['messageId'] = 'other'
+    assert discovered_ids(other_request) == ['1', '2']
+
+    # Stale entry is returned and refreshed in the background
+    refreshed.clear()
+    clock.time = 15
+    assert discovered_ids() == ['1']
+    assert refreshed.wait(5)
+    while home.discovery_cache._refreshing:  # Wait until the response is stored
+        time.sleep(0.001)
+    assert calls == ['OAuth Token', 'Other Token', 'OAuth Token']
+    assert discovered_ids() == ['1', '2', '3']
+
+    # Expired entry calls the handler directly
+    clock.time = 40
+    assert discovered_ids() == ['1', '2', '3', '4']
+
+    home.discovery_cache.invalidate('OAuth Token')
+    assert discovered_ids() == ['1', '2', '3', '4', '5']
+    home.discovery_cache.invalidate()
+    assert discovered_ids(other_request) == ['1', '2', '3', '4', '5', '6']
+    assert home.discovery_cache.hits == 3
+
+    # Results that aren't responses are passed through without caching
+    home.discover_handler(lambda request: None)
+    assert home.lambda_handler(discover_request) is None
+    assert home.lambda_handler(discover_request) is None
+
+
+def test_state_cache(clock):
+    cache = StateCache(ttl=100, clock=clock)
+    timestamp = datetime(2017, 6, 2, 12, 0)
+
+    cache.set('lock1', 'GetLockStateRequest', {'lockState': 'LOCKED'}, timestamp)
+    cache.set('lock2', 'GetLockStateRequest', {'lockState': 'UNLOCKED'})
+    assert cache.get('lock1', 'GetLockStateRequest') == ({'lockState': 'LOCKED'}, timestamp)
+    assert cache.get('lock1', 'GetTargetTemperatureRequest') is None
+
+    clock.time = 50
+    assert cache.get('lock1', 'GetLockStateRequest', max_age=60) is not None
+    assert cache.get('lock1', 'GetLockStateRequest', max_age=30) is None
+    clock.time = 100
+    assert cache.get('lock1', 'GetLockStateRequest') is None
+
+    cache.invalidate('lock2')
+    assert cache.get('lock2', 'GetLockStateRequest') is None
+
+
+def test_response_cache(clock):
+    cache = ResponseCache(ttl=10, wait_timeout=5, clock=clock)
+    key = cache.key({'header': {'messageId': '1', 'name': 'TurnOnRequest'}})
+    assert cache.key({'header': {'name': 'TurnOnRequest'}}) is None
+
+    # First copy owns the key, the second one waits for it
+    assert cache.acquire(key) == (None, None)
+    response, in_flight = cache.acquire(key)
+    assert response is None and in_flight is not None
+
+    cache.release(key, {'header': {}})
+    assert cache.wait(in_flight) == {'header': {}}
+    assert cache.acquire(key) == ({'header': {}}, None)
+
+    clock.time = 10
+    assert cache.acquire(key) == (None, None)
+    # Failed handling wakes up waiters without a response
+    response, in_flight = cache.acquire(key)
+    cache.release(key)
+    assert cache.wait(in_flight) is None
+
+    # Error responses go to waiters but aren't stored
+    error = {'header': {'name': 'TargetOfflineError'}}
+    assert cache.acquire(key) == (None, None)
+    response, in_flight = cache.acquire(key)
+    cache.release(key, error)
+    assert cache.wait(in_flight) is error
+    assert cache.acquire(key) == (None, None)
+    cache.release(key)
+
+    cache = ResponseCache(cache_errors=True)
+    cache.acquire(key)
+    cache.release(key, error)
+    assert cache.acquire(key) == (error, None)
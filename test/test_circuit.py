@@ -0,0 +1,55 @@
+import logging
+
+import pytest
+
+from askhome.circuit import CircuitBreaker
+from askhome.exceptions import (TargetOfflineError, DependentServiceUnavailableError,
+                                ValueOutOfRangeError)
+
+
+def test_circuit_breaker(clock):
+    breaker = CircuitBreaker(failure_threshold=2, recovery_timeout=10, clock=clock)
+
+    breaker.record_failure(TargetOfflineError())
+    # Other errors mean the backend responded
+    breaker.record_failure(ValueOutOfRangeError(0, 100))
+    breaker.record_failure(TargetOfflineError())
+    assert breaker.state == 'closed'
+    breaker.before_call()
+
+    failure = DependentServiceUnavailableError('Vendor Cloud')
+    breaker.record_failure(failure)
+    assert breaker.state == 'open'
+    with pytest.raises(DependentServiceUnavailableError) as excinfo:
+        breaker.before_call()
+    assert excinfo.value is not failure
+    assert excinfo.value.payload == failure.payload
+
+    # Single probe is let through when half-open, failed probe opens the circuit again
+    clock.time = 10
+    assert breaker.state == 'half-open'
+    breaker.before_call()
+    with pytest.raises(DependentServiceUnavailableError):
+        breaker.before_call()
+    breaker.record_failure(TargetOfflineError())
+    assert breaker.state == 'open'
+
+    clock.time = 20
+    breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == 'closed'
+    breaker.before_call()
+
+
+def test_circuit_breaker_log_name(caplog, clock):
+    caplog.set_level(logging.INFO, 'askhome')
+    for name in (None, 'cloud'):
+        breaker = CircuitBreaker(failure_threshold=1, name=name, clock=clock)
+        breaker.record_failure(TargetOfflineError())
+        breaker.record_success()
+
+    messages = [record.getMessage() for record in caplog.records]
+    assert messages[0].startswith('Circuit opened after 1 failures')
+    assert messages[1] == 'Circuit closed'
+    assert messages[2].startswith('Circuit cloud opened')
+    assert messages[3] == 'Circuit cloud closed'
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import json
+
+import pytest
+
+from askhome import Smarthome
+from askhome.codec import get_codec, default_codec, JsonCodec
+
+
+def test_get_codec():
+    assert isinstance(get_codec('json'), JsonCodec)
+    assert default_codec() is default_codec()
+    with pytest.raises(ValueError):
+        get_codec('yaml')
+
+
+@pytest.mark.parametrize('codec_name', ['json', 'orjson', 'ujson'])
+def test_handle_bytes(codec_name, discover_request, Light):
+    try:
+        codec = get_codec(codec_name)
+    except ImportError:
+        pytest.skip('%s is not installed' % codec_name)
+
+    home = Smarthome()
+    home.codec = codec
+    home.add_appliance('light1', Light, name=u'Kitchen Light ☀')
+    raw_request = json.dumps(discover_request).encode('utf-8')
+
+    expected = home.lambda_handler(discover_request)
+    assert json.loads(home.handle_bytes(raw_request).decode('utf-8')) == expected
+    # Second response reuses the encoded payload
+    assert json.loads(home.handle_bytes(raw_request).decode('utf-8')) == expected
+
+    home.add_appliance('light2', Light)
+    response = json.loads(home.handle_bytes(raw_request).decode('utf-8'))
+    assert len(response['payload']['discoveredAppliances']) == 2
+
+    turn_on = {
+        'header': {
+            'messageId': '01ebf625-0b89-4c4d-b3aa-32340e894688',
+            'name': 'TurnOnRequest',
+            'namespace': 'Alexa.ConnectedHome.Control',
+            'payloadVersion': '2'
+        },
+        'payload': {
+            'accessToken': '[OAuth token here]',
+            'appliance': {
+                'additionalApplianceDetails': {},
+                'applianceId': 'light1'
+            }
+        }
+    }
+    response = json.loads(home.handle_bytes(json.dumps(turn_on).encode('utf-8')).decode('utf-8'))
+    assert response['header']['name'] == 'TurnOnConfirmation'
+
+    # The two halves of handle_bytes
+    assert home.decode_event(raw_request) == discover_request
+    response = home.lambda_handler(discover_request)
+    assert home.encode_response(response) == home.handle_bytes(raw_request)
+    with pytest.raises(ValueError):
+        home.decode_event(b'{not json')
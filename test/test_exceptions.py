@@ -1,3 +1,5 @@
+import pytest
+
 from askhome import create_request
 from askhome.exceptions import *
 
@@ -158,4 +160,15 @@ def test_exceptions(discover_request):
 
 
 
+def test_parameterless_exceptions():
+    first, second = TargetOfflineError(), TargetOfflineError()
+    assert first.name == 'TargetOfflineError'
+    assert first.payload == {}
+    # Parameterless exceptions share one read-only payload
+    assert first.payload is second.payload
+    with pytest.raises(TypeError):
+        first.payload['foo'] = 'bar'
 
+    custom = TargetOfflineError(name='CustomError', payload={'foo': 'bar'})
+    assert (custom.name, custom.payload) == ('CustomError', {'foo': 'bar'})
+    assert TargetOfflineError().name == 'TargetOfflineError'
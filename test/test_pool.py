@@ -0,0 +1,155 @@
+import threading
+import time
+
+from askhome import Smarthome, Appliance, AppliancePool
+
+
+def make_light(created, torn_down):
+    class Light(Appliance):
+        def __init__(self, request=None):
+            super(Light, self).__init__(request)
+            created.append(self.id)
+
+        def teardown(self):
+            torn_down.append(self.id)
+
+        @Appliance.action
+        def turn_on(self, request):
+            return request.raw_response({'instance': id(self), 'id': self.id})
+
+    return Light
+
+
+def test_pool_per_id(control_request):
+    created, torn_down = [], []
+    home = Smarthome()
+    home.appliance_pool = AppliancePool(max_size=2)
+    Light = make_light(created, torn_down)
+    for appl_id in ('light1', 'light2', 'light3'):
+        home.add_appliance(appl_id, Light)
+
+    first = home.lambda_handler(control_request('TurnOnRequest', 'light1'))['payload']
+    second = home.lambda_handler(control_request('TurnOnRequest', 'light1'))['payload']
+    assert first == second
+    assert created == ['light1']
+
+    home.lambda_handler(control_request('TurnOnRequest', 'light2'))
+    home.lambda_handler(control_request('TurnOnRequest', 'light3'))
+    assert created == ['light1', 'light2', 'light3']
+    assert torn_down == ['light1']
+    assert len(home.appliance_pool) == 2
+
+    home.appliance_pool.clear()
+    assert torn_down == ['light1', 'light2', 'light3']
+
+
+def test_pool_per_class(control_request):
+    created, torn_down = [], []
+    home = Smarthome()
+    home.appliance_pool = AppliancePool(key='class')
+    Light = make_light(created, torn_down)
+    home.add_appliance('light1', Light)
+    home.add_appliance('light2', Light)
+
+    first = home.lambda_handler(control_request('TurnOnRequest', 'light1'))['payload']
+    second = home.lambda_handler(control_request('TurnOnRequest', 'light2'))['payload']
+    # Same instance is bound to the other request
+    assert first['instance'] == second['instance']
+    assert second['id'] == 'light2'
+    assert created == ['light1']
+
+
+def test_pool_exclusive_instances(control_request):
+    created, torn_down = [], []
+    entered, proceed = threading.Event(), threading.Event()
+
+    class SlowLight(Appliance):
+        def __init__(self, request=None):
+            super(SlowLight, self).__init__(request)
+            created.append(self.id)
+
+        def teardown(self):
+            torn_down.append(self.id)
+
+        @Appliance.action
+        def turn_on(self, request):
+            if not entered.is_set():
+                entered.set()
+                proceed.wait(5)
+            return request.raw_response({'instance': id(self), 'id': self.id})
+
+    home = Smarthome()
+    home.appliance_pool = AppliancePool()
+    home.add_appliance('light1', SlowLight)
+
+    results = []
+    event = control_request('TurnOnRequest', 'light1')
+    thread = threading.Thread(target=lambda: results.append(home.lambda_handler(event)))
+    thread.start()
+    assert entered.wait(5)
+    # The instance is in use by the blocked request, so another one is created
+    second = home.lambda_handler(event)['payload']
+    proceed.set()
+    thread.join(5)
+    assert results[0]['payload']['instance'] != second['instance']
+    assert created == ['light1', 'light1']
+
+    # Only one of them is kept in the pool
+    assert torn_down == ['light1']
+    assert len(home.appliance_pool) == 1
+
+
+def test_pool_discards_broken_instances(control_request, lambda_context):
+    torn_down = []
+    finish = threading.Event()
+
+    class Light(Appliance):
+        def __init__(self, request=None):
+            # Doesn't call the parent __init__, so the instance has no id until bound
+            self.sessions = 1
+
+        def teardown(self):
+            torn_down.append(self)
+
+        @Appliance.action
+        def turn_on(self, request):
+            raise RuntimeError
+
+        @Appliance.action
+        def turn_off(self, request):
+            finish.wait(5)
+
+        @Appliance.action
+        def set_percentage(self, request):
+            pass
+
+    home = Smarthome()
+    home.appliance_pool = AppliancePool()
+    home.add_appliance('light1', Light)
+
+    # Instances are kept even when the parent __init__ isn't called
+    home.lambda_handler(control_request('SetPercentageRequest', 'light1'))
+    assert len(home.appliance_pool) == 1
+
+    # Instances of actions raising unexpected exceptions are torn down
+    for _ in range(3):
+        try:
+            home.lambda_handler(control_request('TurnOnRequest', 'light1'))
+        except RuntimeError:
+            pass
+    assert len(torn_down) == 3
+    assert len(home.appliance_pool) == 0
+
+    # Instances of abandoned actions are torn down when the action finishes
+    home.deadline_margin = 0
+    event = control_request('TurnOffRequest', 'light1')
+    response = home.lambda_handler(event, lambda_context(50))
+    assert response['header']['name'] == 'TargetOfflineError'
+    assert len(torn_down) == 3
+    finish.set()
+    for _ in range(100):
+        if len(torn_down) == 4:
+            break
+        time.sleep(0.01)
+    assert len(torn_down) == 4
+    assert len(home.appliance_pool) == 0
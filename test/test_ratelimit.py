@@ -0,0 +1,47 @@
+import pytest
+
+from askhome.exceptions import RateLimitExceededError
+from askhome.ratelimit import RateLimit
+
+
+def test_token_bucket(clock):
+    limit = RateLimit(2, 'MINUTE', clock=clock)
+
+    assert limit.acquire('light1')
+    assert limit.acquire('light1')
+    assert not limit.acquire('light1')
+    # Other keys have their own buckets
+    assert limit.acquire('light2')
+
+    # One token is refilled every 30 seconds
+    clock.time = 30
+    assert limit.acquire('light1')
+    assert not limit.acquire('light1')
+
+    limit.reset('light1')
+    assert limit.acquire('light1')
+
+    exception = limit.exception()
+    assert isinstance(exception, RateLimitExceededError)
+    assert exception.payload == {'rateLimit': 2, 'timeUnit': 'MINUTE'}
+
+
+def test_burst_and_pruning(clock):
+    limit = RateLimit(60, 'MINUTE', burst=1, max_keys=2, clock=clock)
+
+    assert limit.acquire('a')
+    assert not limit.acquire('a')
+    assert limit.acquire('b')
+
+    # Only refilled buckets are dropped when there are too many
+    clock.time = 0.5
+    assert limit.acquire('c')
+    assert len(limit._buckets) == 3
+    clock.time = 2
+    assert limit.acquire('d')
+    assert sorted(limit._buckets) == ['d']
+
+
+def test_invalid_time_unit():
+    with pytest.raises(ValueError):
+        RateLimit(1, 'WEEK')
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from askhome import Smarthome, Appliance
+from askhome.registry import DictRegistry, SQLiteRegistry, SnapshotRegistry
+
+
+class Light(Appliance):
+    @Appliance.action
+    def turn_on(self, request):
+        return request.raw_response({'id': self.id})
+
+
+class Door(Appliance):
+    @Appliance.action
+    def set_lock_state(self, request):
+        pass
+
+
+def fill(home):
+    home.add_appliances([
+        ('light1', Light, 'Kitchen Light'),
+        ('light2', Light, u'Bedroom Light ☀'),
+        ('door1', Door, 'Front Door'),
+    ])
+
+
+def check_registry(home, discover_request, control_request):
+    registry = home.appliances
+    assert len(registry) == 3
+    assert 'light1' in registry
+    assert 'light3' not in registry
+    assert registry.get('light3') is None
+    assert registry['door1'][0] is Door
+    assert registry['light2'][1]['friendlyName'] == u'Bedroom Light ☀'
+    with pytest.raises(KeyError):
+        registry['light3']
+
+    response = home.lambda_handler(control_request('TurnOnRequest', 'light2'))
+    assert response['payload'] == {'id': 'light2'}
+    response = home.lambda_handler(control_request('TurnOnRequest', 'light3'))
+    assert response['header']['name'] == 'UnsupportedTargetError'
+
+    discovered = home.lambda_handler(discover_request)['payload']['discoveredAppliances']
+    assert sorted(appl['applianceId'] for appl in discovered) == ['door1', 'light1', 'light2']
+
+
+def test_dict_registry(discover_request, control_request):
+    home = Smarthome()
+    fill(home)
+    assert isinstance(home.appliances, DictRegistry)
+    check_registry(home, discover_request, control_request)
+
+    home.appliances = {}
+    assert isinstance(home.appliances, DictRegistry)
+    assert home.lambda_handler(discover_request)['payload']['discoveredAppliances'] == []
+
+
+def test_sqlite_registry(tmpdir, discover_request, control_request):
+    path = str(tmpdir.join('appliances.db'))
+    home = Smarthome()
+    home.appliances = SQLiteRegistry(path)
+    fill(home)
+    home.appliances.close()
+
+    # Reading the database needs the classes
+    home = Smarthome()
+    home.appliances = SQLiteRegistry(path, classes=[Light, Door])
+    check_registry(home, discover_request, control_request)
+
+    home.remove_appliance('door1')
+    assert len(home.appliances) == 2
+    with pytest.raises(KeyError):
+        home.remove_appliance('door1')
+
+    home.appliances = SQLiteRegistry(path, classes=[Door])
+    with pytest.raises(LookupError):
+        list(home.appliances.values())
+
+
+def test_snapshot_registry(tmpdir, discover_request, control_request):
+    source = Smarthome()
+    fill(source)
+    path = str(tmpdir.join('appliances.snapshot'))
+    SnapshotRegistry.write(path, source.appliances)
+
+    home = Smarthome()
+    home.appliances = SnapshotRegistry(path, classes=[Light, Door])
+    check_registry(home, discover_request, control_request)
+
+    with pytest.raises(TypeError):
+        home.add_appliance('light3', Light)
+    home.appliances.close()
+
+    with open(path, 'wb') as f:
+        f.write(b'something else')
+    with pytest.raises(ValueError):
+        SnapshotRegistry(path)
@@ -1,6 +1,7 @@
 from datetime import datetime
 
 from askhome import create_request
+from askhome.requests import Request, PercentageRequest, register_request
 
 
 def test_discovery_request(discover_request):
@@ -281,4 +282,90 @@ def test_health_check():
             'isHealthy': False,
             'description': 'The system is currently not healthy'
         }
-    }
\ No newline at end of file
+    }
+
+
+def test_request_registry():
+    class FooRequest(Request):
+        request_names = ('FooRequest',)
+
+    class FooV3Request(FooRequest):
+        payload_version = '3'
+        request_names = ('FooRequest',)
+
+    class BarRequest(FooRequest):
+        pass
+
+    def request_data(name, version='2'):
+        return {
+            'header': {
+                'namespace': 'Alexa.ConnectedHome.Control',
+                'name': name,
+                'payloadVersion': version,
+                'messageId': '23624201-23a5-44c3-8fdc-ec6c4b6c3df8'
+            },
+            'payload': {}
+        }
+
+    assert type(create_request(request_data('FooRequest'))) is FooRequest
+    assert type(create_request(request_data('FooRequest', '3'))) is FooV3Request
+    # Subclasses don't take over the names of their parents
+    assert type(create_request(request_data('BarRequest'))) is Request
+
+    register_request(BarRequest, 'BarRequest')
+    assert type(create_request(request_data('BarRequest'))) is BarRequest
+    assert type(create_request(request_data('SetPercentageRequest'))) is PercentageRequest
+
+
+def test_percentage_request_cached():
+    request = create_request({
+        'header': {
+            'namespace': 'Alexa.ConnectedHome.Control',
+            'name': 'SetPercentageRequest',
+            'payloadVersion': '2',
+            'messageId': '23624201-23a5-44c3-8fdc-ec6c4b6c3df8'
+        },
+        'payload': {
+            'accessToken': '[OAuth token here]',
+            'appliance': {
+                'applianceId': 'light1',
+                'additionalApplianceDetails': {}
+            },
+            'percentageState': {
+                'value': '42'
+            }
+        }
+    })
+
+    assert not hasattr(request, '__dict__')
+    assert request.percentage == 42.0
+    assert request.percentage is request.percentage
+    assert request.delta_percentage is None
+    assert request.appliance_id == 'light1'
+
+    assert request.custom_data == {}
+    request.custom_data['foo'] = 'bar'
+    assert request.custom_data == {'foo': 'bar'}
+    request.custom_data = 'baz'
+    assert request.custom_data == 'baz'
+
+
+def test_response_names():
+    def response_name(name, namespace):
+        return create_request({
+            'header': {
+                'namespace': namespace,
+                'name': name,
+                'payloadVersion': '2',
+                'messageId': '23624201-23a5-44c3-8fdc-ec6c4b6c3df8'
+            },
+            'payload': {}
+        }).response_header()['name']
+
+    # Precomputed names
+    assert response_name('TurnOnRequest', 'Alexa.ConnectedHome.Control') == 'TurnOnConfirmation'
+    assert response_name('GetLockStateRequest', 'Alexa.ConnectedHome.Query') == \
+        'GetLockStateResponse'
+    # Names of unknown requests are computed
+    assert response_name('BlinkRequest', 'Alexa.ConnectedHome.Control') == 'BlinkConfirmation'
+    assert response_name('TurnOnRequest', 'Custom.Namespace') == 'TurnOnResponse'
@@ -0,0 +1,260 @@
+import asyncio
+import http.client
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import textwrap
+import threading
+import time
+
+import pytest
+
+from askhome import Appliance, Smarthome
+from askhome.server import ServerStats, SmarthomeServer
+
+
+class SlowLight(Appliance):
+    started = None
+
+    @Appliance.action
+    def turn_on(self, request):
+        SlowLight.started.set()
+        time.sleep(0.2)
+
+
+@pytest.fixture
+def serve():
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    servers = []
+
+    def start(home, **kwargs):
+        server = SmarthomeServer(home, port=0, **kwargs)
+        asyncio.run_coroutine_threadsafe(server.start(), loop).result(5)
+        servers.append(server)
+        return server
+
+    def close(server):
+        asyncio.run_coroutine_threadsafe(server.close(5), loop).result(10)
+        servers.remove(server)
+
+    start.close = close
+    yield start
+
+    for server in servers:
+        close(server)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(5)
+    loop.close()
+
+
+@pytest.fixture
+def turn_on_event(control_request):
+    return control_request('TurnOnRequest', 'light1')
+
+
+def post(connection, event, path='/'):
+    connection.request('POST', path, json.dumps(event), {'Content-Type': 'application/json'})
+    response = connection.getresponse()
+    return response.status, response.read()
+
+
+def test_keep_alive(serve, Light, turn_on_event):
+    home = Smarthome()
+    home.add_appliance('light1', Light)
+    server = serve(home)
+
+    connection = http.client.HTTPConnection('127.0.0.1', server.port, timeout=5)
+    for _ in range(3):
+        status, body = post(connection, turn_on_event)
+        assert status == 200
+        assert json.loads(body.decode('utf-8')) == home.lambda_handler(turn_on_event)
+    # All requests went over a single connection
+    assert len(server._connections) == 1
+    connection.close()
+
+
+def test_async_handling(serve, turn_on_event):
+    class AsyncLight(Appliance):
+        @Appliance.action
+        async def turn_on(self, request):
+            await asyncio.sleep(0)
+
+    home = Smarthome()
+    home.add_appliance('light1', AsyncLight)
+    server = serve(home, use_async=True)
+
+    connection = http.client.HTTPConnection('127.0.0.1', server.port, timeout=5)
+    status, body = post(connection, turn_on_event)
+    assert status == 200
+    assert json.loads(body.decode('utf-8'))['header']['name'] == 'TurnOnConfirmation'
+
+
+def test_errors(serve, Light, turn_on_event, control_request):
+    home = Smarthome()
+    server = serve(home)
+
+    connection = http.client.HTTPConnection('127.0.0.1', server.port, timeout=5)
+    assert post(connection, turn_on_event, path='/other')[0] == 404
+
+    connection.request('GET', '/')
+    response = connection.getresponse()
+    response.read()
+    assert response.status == 405
+
+    connection.request('POST', '/', b'{not json')
+    response = connection.getresponse()
+    response.read()
+    assert response.status == 400
+
+    # Unknown appliance is a regular Alexa error response
+    status, body = post(connection, control_request('TurnOnRequest', 'missing'))
+    assert status == 200
+    assert json.loads(body.decode('utf-8'))['header']['name'] == 'UnsupportedTargetError'
+
+
+@pytest.mark.parametrize('use_async', [False, True])
+def test_action_value_error(serve, use_async, turn_on_event):
+    class BrokenLight(Appliance):
+        @Appliance.action
+        def turn_on(self, request):
+            raise ValueError('bug in the action')
+
+    home = Smarthome()
+    home.add_appliance('light1', BrokenLight)
+    server = serve(home, use_async=use_async)
+
+    # Only malformed events are client errors
+    connection = http.client.HTTPConnection('127.0.0.1', server.port, timeout=5)
+    assert post(connection, turn_on_event)[0] == 500
+
+
+def test_graceful_close(serve, turn_on_event):
+    SlowLight.started = threading.Event()
+    home = Smarthome()
+    home.add_appliance('light1', SlowLight)
+    server = serve(home)
+
+    idle = http.client.HTTPConnection('127.0.0.1', server.port, timeout=5)
+    assert post(idle, turn_on_event)[0] == 200
+    SlowLight.started.clear()
+
+    results = []
+    busy = http.client.HTTPConnection('127.0.0.1', server.port, timeout=5)
+    thread = threading.Thread(target=lambda: results.append(post(busy, turn_on_event)))
+    thread.start()
+    assert SlowLight.started.wait(5)
+
+    serve.close(server)
+    thread.join(5)
+    # The request being handled is finished before the server closes
+    assert results[0][0] == 200
+
+
+def test_stats(serve, Light, turn_on_event):
+    home = Smarthome()
+    home.add_appliance('light1', Light)
+    stats = ServerStats(2)
+    stats.slot = 1
+    server = serve(home, stats=stats, stats_path='/stats')
+
+    connection = http.client.HTTPConnection('127.0.0.1', server.port, timeout=5)
+    post(connection, turn_on_event)
+    post(connection, turn_on_event, path='/other')
+
+    connection.request('GET', '/stats')
+    totals = json.loads(connection.getresponse().read().decode('utf-8'))
+    assert totals['requests'] == 2
+    assert totals['errors'] == 1
+    assert totals['workers'][0]['requests'] == 0
+    assert totals['workers'][1]['requests'] == 2
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires os.fork')
+def test_serve_workers(tmpdir, turn_on_event):
+    port = free_port()
+    script = tmpdir.join('skill.py')
+    script.write(textwrap.dedent("""
+        from askhome import Appliance, Smarthome
+        from askhome.server import serve_workers
+
+        class Light(Appliance):
+            @Appliance.action
+            def turn_on(self, request):
+                pass
+
+        home = Smarthome()
+        home.add_appliance('light1', Light)
+        stats = serve_workers(home, port=%d, processes=2, stats_path='/stats')
+        print(int(stats.totals()['requests']))
+    """ % port))
+
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(__file__)))
+    process = subprocess.Popen([sys.executable, str(script)], stdout=subprocess.PIPE, env=env)
+    try:
+        for _ in range(100):
+            try:
+                connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+                status, body = post(connection, turn_on_event)
+                break
+            except ConnectionError:
+                time.sleep(0.05)
+        assert status == 200
+        assert json.loads(body.decode('utf-8'))['header']['name'] == 'TurnOnConfirmation'
+
+        for _ in range(4):
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            assert post(connection, turn_on_event)[0] == 200
+            connection.close()
+
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+        connection.request('GET', '/stats')
+        totals = json.loads(connection.getresponse().read().decode('utf-8'))
+        connection.close()
+        assert len(totals['workers']) == 2
+        assert totals['requests'] == 5
+    finally:
+        process.send_signal(signal.SIGTERM)
+        output, _ = process.communicate(timeout=10)
+
+    assert process.returncode == 0
+    # The stats request itself is counted after reading the totals
+    assert int(output) == 6
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires os.fork')
+def test_serve_workers_failing(tmpdir):
+    script = tmpdir.join('skill.py')
+    script.write(textwrap.dedent("""
+        import logging
+        from askhome import Smarthome, server
+
+        logging.basicConfig()
+        server._RESTART_DELAY = 0.01
+        # Every worker fails on the unknown argument
+        server.serve_workers(Smarthome(), port=%d, processes=2, unknown_argument=True)
+    """ % free_port()))
+
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(__file__)))
+    process = subprocess.Popen([sys.executable, str(script)], stderr=subprocess.PIPE, env=env)
+    try:
+        _, errors = process.communicate(timeout=30)
+    finally:
+        process.kill()
+
+    assert process.returncode != 0
+    errors = errors.decode('utf-8')
+    assert 'Worker 0 exited with status 1, restarting' in errors
+    assert 'keeps exiting right after starting' in errors
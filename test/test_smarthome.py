@@ -1,7 +1,16 @@
+import logging
+import threading
+import time
+import traceback
+
 import pytest
 
-from askhome import Smarthome, Appliance
-from askhome.exceptions import TargetOfflineError
+from askhome import Smarthome, Appliance, ResponseCache, logger
+from askhome.cache import StateCache, TTLCache
+from askhome.exceptions import TargetOfflineError, DriverInternalError
+from askhome.auth import TokenValidator
+from askhome.circuit import CircuitBreaker
+from askhome.ratelimit import RateLimit
 
 
 @pytest.fixture
@@ -420,3 +429,569 @@ def test_full_usage(discover_request):
             }
         }
     }
+
+
+def test_discovery_payload_cached(discover_request, Light):
+    home = Smarthome()
+    home.add_appliance('1', Light, name='Kitchen Light')
+
+    payload = home.lambda_handler(discover_request)['payload']
+    # Payload is reused until the registered appliances change
+    assert home.lambda_handler(discover_request)['payload'] is payload
+
+    home.add_appliance('2', Light, name='Bedroom Light')
+    payload = home.lambda_handler(discover_request)['payload']
+    assert sorted(appl['applianceId'] for appl in payload['discoveredAppliances']) == ['1', '2']
+
+    home.remove_appliance('1')
+    payload = home.lambda_handler(discover_request)['payload']
+    assert [appl['applianceId'] for appl in payload['discoveredAppliances']] == ['2']
+
+    with pytest.raises(KeyError):
+        home.remove_appliance('1')
+
+    # The shared payload can't be modified
+    details = payload['discoveredAppliances'][0]
+    for modify in (lambda: payload['discoveredAppliances'].append(details),
+                   lambda: details.update(friendlyName='Changed'),
+                   lambda: details['actions'].append('turnOn'),
+                   lambda: details['additionalApplianceDetails'].update(extra='1')):
+        with pytest.raises(TypeError):
+            modify()
+
+    # Appliances assigned to the registry directly are discovered too
+    home.appliances['3'] = (Light, {'applianceId': '3', 'actions': ['turnOn']})
+    payload = home.lambda_handler(discover_request)['payload']
+    assert sorted(appl['applianceId'] for appl in payload['discoveredAppliances']) == ['2', '3']
+    del home.appliances['3']
+    payload = home.lambda_handler(discover_request)['payload']
+    assert [appl['applianceId'] for appl in payload['discoveredAppliances']] == ['2']
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+@pytest.fixture
+def log_records():
+    handler = ListHandler()
+    level = logger.level
+    logger.addHandler(handler)
+    yield handler.records
+    logger.removeHandler(handler)
+    logger.setLevel(level)
+
+
+def test_payload_logging(discover_request, log_records):
+    home = Smarthome()
+
+    logger.setLevel(logging.INFO)
+    home.lambda_handler(discover_request)
+    assert log_records == []
+
+    logger.setLevel(logging.DEBUG)
+    home.lambda_handler(discover_request)
+    assert len(log_records) == 2
+    assert log_records[0].getMessage().startswith('{\n  "header"')
+
+    del log_records[:]
+    home.payload_log_indent = None
+    home.payload_log_level = logging.INFO
+    logger.setLevel(logging.INFO)
+    home.lambda_handler(discover_request)
+    assert log_records[1].getMessage().startswith('{"header":{')
+
+    del log_records[:]
+    home.payload_log_sample_rate = 0
+    home.lambda_handler(discover_request)
+    assert log_records == []
+
+
+def test_handle_batch(discover_request, control_request):
+    handled = []
+
+    class Light(Appliance):
+        @Appliance.action
+        def turn_on(self, request):
+            handled.append((self.id, 'on'))
+
+        @Appliance.action
+        def turn_off(self, request):
+            handled.append((self.id, 'off'))
+
+        @Appliance.action
+        def set_percentage(self, request):
+            raise ValueError('Broken backend')
+
+        @Appliance.action
+        def set_target_temperature(self, request):
+            raise TargetOfflineError
+
+    home = Smarthome()
+    home.add_appliance('light1', Light)
+    home.add_appliance('light2', Light)
+
+    responses = home.handle_batch([
+        control_request('TurnOnRequest', 'light1'),
+        control_request('SetPercentageRequest', 'light2'),
+        discover_request,
+        control_request('TurnOffRequest', 'light1'),
+        control_request('SetTargetTemperatureRequest', 'light2'),
+        {'broken': 'event'},
+    ])
+
+    assert [response and response['header']['name'] for response in responses] == [
+        'TurnOnConfirmation',
+        'DriverInternalError',
+        'DiscoverAppliancesResponse',
+        'TurnOffConfirmation',
+        'TargetOfflineError',
+        None,
+    ]
+    # Events for the same appliance are handled in order
+    assert [action for appl_id, action in handled if appl_id == 'light1'] == ['on', 'off']
+
+    assert home.handle_batch([]) == []
+
+
+def test_handle_batch_without_semaphores(monkeypatch, Light, control_request):
+    import multiprocessing.synchronize
+
+    # AWS Lambda has no /dev/shm, so multiprocessing can't create semaphores there
+    def no_semaphores(*args, **kwargs):
+        raise OSError(38, 'Function not implemented')
+    monkeypatch.setattr(multiprocessing.synchronize.SemLock, '__init__', no_semaphores)
+
+    home = Smarthome()
+    home.add_appliance('light1', Light)
+    home.add_appliance('light2', Light)
+    responses = home.handle_batch([control_request('TurnOnRequest', 'light1'),
+                                   control_request('TurnOnRequest', 'light2')])
+    assert [response['header']['name'] for response in responses] == ['TurnOnConfirmation'] * 2
+
+
+def test_metrics_handler(discover_request, control_request):
+    class Light(Appliance):
+        @Appliance.action
+        def turn_on(self, request):
+            pass
+
+        @Appliance.action
+        def turn_off(self, request):
+            raise TargetOfflineError
+
+    home = Smarthome()
+    home.add_appliance('light1', Light)
+    stages = []
+
+    @home.metrics_handler
+    def metrics(stage, duration, request_name, appliance_cls):
+        assert duration >= 0
+        stages.append((stage, request_name, appliance_cls))
+
+    home.lambda_handler(control_request('TurnOnRequest', 'light1'))
+    assert stages == [
+        ('parse', 'TurnOnRequest', None),
+        ('lookup', 'TurnOnRequest', Light),
+        ('construct', 'TurnOnRequest', Light),
+        ('action', 'TurnOnRequest', Light),
+        ('response', 'TurnOnRequest', Light),
+    ]
+
+    del stages[:]
+    home.lambda_handler(control_request('TurnOffRequest', 'light1'))
+    assert [stage for stage, _, _ in stages] == ['parse', 'lookup', 'construct', 'error']
+
+    del stages[:]
+    home.prepare_handler(lambda request: None)
+    home.lambda_handler(discover_request)
+    assert stages == [
+        ('parse', 'DiscoverAppliancesRequest', None),
+        ('prepare', 'DiscoverAppliancesRequest', None),
+        ('response', 'DiscoverAppliancesRequest', None),
+    ]
+
+
+def test_add_appliances(discover_request, Light):
+    class Door(Appliance):
+        @Appliance.action
+        def set_lock_state(self, request):
+            pass
+
+        class Details:
+            manufacturer = 'EvilCorp'
+
+    home = Smarthome(manufacturer='NeutralCorp', model='Door')
+    rows = iter([
+        ('1', Door, 'Front Door'),
+        {'appl_id': '2', 'appl_class': Door, 'name': 'Back Door', 'manufacturer': 'GoodCorp'},
+        ('3', Light, 'Kitchen Light', 'Above the sink'),
+    ])
+    home.add_appliances(rows)
+
+    expected = Smarthome(manufacturer='NeutralCorp', model='Door')
+    expected.add_appliance('1', Door, name='Front Door')
+    expected.add_appliance('2', Door, name='Back Door', manufacturer='GoodCorp')
+    expected.add_appliance('3', Light, name='Kitchen Light', description='Above the sink')
+
+    assert home.appliances == expected.appliances
+    assert home.appliances['1'][1]['actions'] is home.appliances['2'][1]['actions']
+
+    response = home.lambda_handler(discover_request)
+    assert len(response['payload']['discoveredAppliances']) == 3
+
+    # Invalid rows are rejected like invalid add_appliance arguments
+    for row in ({'appl_id': '4', 'appl_class': Light, 'manufactuer': 'Typo'},
+                ('4', Light) + (None,) * 9,
+                {'appl_id': '4'}):
+        with pytest.raises(TypeError):
+            home.add_appliances([row])
+    assert '4' not in home.appliances
+
+
+def test_appliance_class_cache(Light, control_request):
+    home = Smarthome()
+    home.appliance_class_cache = TTLCache(max_size=10, ttl=60)
+    calls = []
+
+    @home.get_appliance_handler
+    def get_appliance(request):
+        calls.append(request.appliance_id)
+        return Light
+
+    light1 = control_request('TurnOnRequest', 'light1')
+    for _ in range(3):
+        assert home.lambda_handler(light1)['header']['name'] == 'TurnOnConfirmation'
+    assert calls == ['light1']
+
+    # Different details are cached separately
+    light1['payload']['appliance']['additionalApplianceDetails'] = {'type': 'Light'}
+    home.lambda_handler(light1)
+    home.lambda_handler(control_request('TurnOnRequest', 'light2'))
+    assert calls == ['light1', 'light1', 'light2']
+    assert (home.appliance_class_cache.hits, home.appliance_class_cache.misses) == (2, 3)
+
+
+def test_exception_log_policy(log_records, control_request):
+    class Light(Appliance):
+        @Appliance.action
+        def turn_on(self, request):
+            raise TargetOfflineError
+
+    home = Smarthome()
+    home.add_appliance('light1', Light)
+    logger.setLevel(logging.INFO)
+    request = control_request('TurnOnRequest', 'light1')
+
+    home.lambda_handler(request)
+    assert log_records[-1].exc_info is not None
+
+    try:
+        TargetOfflineError.log_policy = 'summary'
+        home.lambda_handler(request)
+        assert len(log_records) == 2
+        assert log_records[-1].exc_info is None
+        assert 'TargetOfflineError' in log_records[-1].getMessage()
+
+        TargetOfflineError.log_policy = 'none'
+        home.lambda_handler(request)
+        TargetOfflineError.log_policy = 0.0
+        home.lambda_handler(request)
+        assert len(log_records) == 2
+
+        TargetOfflineError.log_policy = 1.0
+        home.lambda_handler(request)
+        assert len(log_records) == 3
+
+        # Unknown policy is reported and the exception logged as by default
+        TargetOfflineError.log_policy = 'summry'
+        response = home.lambda_handler(request)
+        assert response['header']['name'] == 'TargetOfflineError'
+        assert log_records[-2].levelno == logging.WARNING
+        assert 'summry' in log_records[-2].getMessage()
+        assert log_records[-1].exc_info is not None
+    finally:
+        del TargetOfflineError.log_policy
+
+
+# Python 3.12 deprecated the three argument form of generator.throw
+@pytest.mark.filterwarnings('error::DeprecationWarning')
+def test_exception_traceback_logged(log_records, control_request, lambda_context):
+    class Light(Appliance):
+        @Appliance.action
+        def turn_on(self, request):
+            raise TargetOfflineError
+
+    home = Smarthome()
+    home.add_appliance('light1', Light)
+    logger.setLevel(logging.INFO)
+
+    home.lambda_handler(control_request('TurnOnRequest', 'light1'))
+    frames = traceback.extract_tb(log_records[-1].exc_info[2])
+    assert frames[-1][2] == 'turn_on'
+
+    # Also when the action runs in a thread bounded by a deadline
+    home.deadline_margin = 0
+    home.lambda_handler(control_request('TurnOnRequest', 'light1'), lambda_context(5000))
+    frames = traceback.extract_tb(log_records[-1].exc_info[2])
+    assert frames[-1][2] == 'turn_on'
+
+
+def test_freeze(discover_request, Light):
+    import gc
+
+    home = Smarthome()
+    home.add_appliance('1', Light, name='Kitchen Light')
+    home.freeze()
+    if hasattr(gc, 'unfreeze'):
+        assert gc.get_freeze_count() > 0
+        gc.unfreeze()
+
+    # Discovery is built and encoded before handling any request
+    assert home._encoded_discovery is not None
+    response = home.lambda_handler(discover_request)
+    assert response['payload'] is home.discovery_payload
+
+
+def test_state_cache(control_request):
+    calls = []
+
+    class Thermostat(Appliance):
+        @Appliance.action
+        def set_target_temperature(self, request):
+            return request.response(request.temperature, mode='HEAT')
+
+        @Appliance.action
+        def increment_target_temperature(self, request):
+            return request.response(24.5)
+
+        @Appliance.action
+        def get_target_temperature(self, request):
+            calls.append(request)
+            return request.cached_response(max_age=60) or request.response(20.0)
+
+        @Appliance.action
+        def get_temperature_reading(self, request):
+            return (request.cached_response() or
+                    request.response(21.0, timestamp='2017-01-01T12:00:00'))
+
+    home = Smarthome()
+    home.state_cache = StateCache()
+    home.add_appliance('thermostat1', Thermostat)
+
+    query = control_request('GetTargetTemperatureRequest', 'thermostat1')
+    query['header']['namespace'] = 'Alexa.ConnectedHome.Query'
+    response = home.lambda_handler(query)
+    assert response['payload']['targetTemperature'] == {'value': 20.0}
+
+    control = control_request('SetTargetTemperatureRequest', 'thermostat1')
+    control['payload']['targetTemperature'] = {'value': 23.5}
+    home.lambda_handler(control)
+
+    # State set by the control request is returned with the time it was recorded
+    response = home.lambda_handler(query)
+    assert response['header']['name'] == 'GetTargetTemperatureResponse'
+    assert response['payload']['targetTemperature'] == {'value': 23.5}
+    assert response['payload']['temperatureMode'] == {'value': 'HEAT'}
+    assert 'applianceResponseTimestamp' in response['payload']
+    assert len(calls) == 2
+
+    # Control response without mode keeps the recorded one
+    home.lambda_handler(control_request('IncrementTargetTemperatureRequest', 'thermostat1'))
+    response = home.lambda_handler(query)
+    assert response['payload']['targetTemperature'] == {'value': 24.5}
+    assert response['payload']['temperatureMode'] == {'value': 'HEAT'}
+
+    # Nothing is recorded when the mode isn't known
+    home.state_cache.invalidate()
+    home.lambda_handler(control_request('IncrementTargetTemperatureRequest', 'thermostat1'))
+    assert home.state_cache.get('thermostat1', 'GetTargetTemperatureRequest') is None
+
+    # Timestamps passed as strings are kept
+    reading = control_request('GetTemperatureReadingRequest', 'thermostat1')
+    reading['header']['namespace'] = 'Alexa.ConnectedHome.Query'
+    home.lambda_handler(reading)
+    response = home.lambda_handler(reading)
+    assert response['payload']['applianceResponseTimestamp'] == '2017-01-01T12:00:00'
+
+
+def test_response_cache(control_request):
+    calls = []
+    started = threading.Event()
+
+    class Light(Appliance):
+        @Appliance.action
+        def turn_on(self, request):
+            calls.append(request)
+            started.set()
+            time.sleep(0.05)
+
+        @Appliance.action
+        def turn_off(self, request):
+            calls.append(request)
+            raise RuntimeError
+
+    home = Smarthome()
+    home.response_cache = ResponseCache()
+    home.add_appliance('light1', Light)
+    event = control_request('TurnOnRequest', 'light1')
+
+    responses = []
+    thread = threading.Thread(target=lambda: responses.append(home.lambda_handler(event)))
+    thread.start()
+    started.wait(5)
+    # Duplicate arriving while the first copy runs waits for its response
+    duplicate = home.lambda_handler(event)
+    thread.join()
+    assert duplicate is responses[0]
+    assert home.lambda_handler(event) is duplicate
+    assert len(calls) == 1
+
+    # Another message id is handled again
+    home.lambda_handler(control_request('TurnOnRequest', 'light1', message_id='other'))
+    assert len(calls) == 2
+
+    # Failed events aren't cached
+    event = control_request('TurnOffRequest', 'light1')
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            home.lambda_handler(event)
+    assert len(calls) == 4
+
+    # Neither are error responses
+    hits = home.response_cache.hits
+    event = control_request('TurnOnRequest', 'missing', message_id='missing')
+    for _ in range(2):
+        assert home.lambda_handler(event)['header']['name'] == 'UnsupportedTargetError'
+    assert home.response_cache.hits == hits
+
+
+def test_rate_limit(control_request):
+    constructed = []
+
+    class Light(Appliance):
+        rate_limit = RateLimit(1)
+        class_rate_limit = RateLimit(3)
+
+        def __init__(self, request=None):
+            constructed.append(request)
+            super(Light, self).__init__(request)
+
+        @Appliance.action
+        def turn_on(self, request):
+            pass
+
+    home = Smarthome()
+    home.add_appliance('light1', Light)
+    home.add_appliance('light2', Light, rate_limit=RateLimit(5, 'MINUTE'))
+    home.add_appliance('light3', Light)
+
+    def turn_on(appliance_id):
+        return home.lambda_handler(control_request('TurnOnRequest', appliance_id))
+
+    assert turn_on('light1')['header']['name'] == 'TurnOnConfirmation'
+    response = turn_on('light1')
+    assert response['header']['name'] == 'RateLimitExceededError'
+    assert response['payload'] == {'rateLimit': 1, 'timeUnit': 'HOUR'}
+
+    # Appliance limit is overridden, the class limit is shared by all appliances
+    assert turn_on('light2')['header']['name'] == 'TurnOnConfirmation'
+    assert turn_on('light2')['header']['name'] == 'TurnOnConfirmation'
+    response = turn_on('light3')
+    assert response['header']['name'] == 'RateLimitExceededError'
+    assert response['payload'] == {'rateLimit': 3, 'timeUnit': 'HOUR'}
+
+    # Limited requests never construct the appliance
+    assert len(constructed) == 3
+
+
+def test_circuit_breaker(control_request):
+    calls = []
+
+    class Light(Appliance):
+        circuit_breaker = CircuitBreaker(failure_threshold=2)
+
+        @Appliance.action
+        def turn_on(self, request):
+            calls.append(request)
+            raise TargetOfflineError
+
+    home = Smarthome()
+    home.add_appliance('light1', Light)
+    for _ in range(3):
+        response = home.lambda_handler(control_request('TurnOnRequest', 'light1'))
+        assert response['header']['name'] == 'TargetOfflineError'
+
+    # The third request was answered without calling the action
+    assert len(calls) == 2
+    assert Light.circuit_breaker.state == 'open'
+
+
+def test_deadline(control_request, lambda_context):
+    seen = []
+
+    class Light(Appliance):
+        @Appliance.action
+        def turn_on(self, request):
+            seen.append(request.remaining_time)
+
+        @Appliance.action
+        def turn_off(self, request):
+            time.sleep(0.5)
+
+    home = Smarthome()
+    home.add_appliance('light1', Light)
+
+    # Deadlines are computed only with a margin set
+    home.lambda_handler(control_request('TurnOnRequest', 'light1'), lambda_context(1000))
+    assert seen == [None]
+
+    home.deadline_margin = 0.1
+    response = home.lambda_handler(control_request('TurnOnRequest', 'light1'),
+                                   lambda_context(1000))
+    assert response['header']['name'] == 'TurnOnConfirmation'
+    assert 0.5 < seen[1] <= 0.9
+
+    start = time.time()
+    response = home.lambda_handler(control_request('TurnOffRequest', 'light1'),
+                                   lambda_context(200))
+    assert response['header']['name'] == 'TargetOfflineError'
+    assert time.time() - start < 0.4
+
+    # Budget already exhausted, the action isn't called at all
+    home.deadline_exception = DriverInternalError
+    response = home.lambda_handler(control_request('TurnOnRequest', 'light1'), lambda_context(50))
+    assert response['header']['name'] == 'DriverInternalError'
+    assert len(seen) == 2
+
+
+def test_token_validator(discover_request, Light, control_request):
+    calls = []
+
+    def introspect(token):
+        calls.append(token)
+        return {'active': token == '[OAuth token here]', 'sub': 'user1'}
+
+    seen = []
+    home = Smarthome()
+    home.token_validator = TokenValidator(introspect)
+    home.add_appliance('light1', Light)
+
+    @home.prepare_handler
+    def prepare(request):
+        seen.append(request.token_info)
+
+    for _ in range(2):
+        response = home.lambda_handler(control_request('TurnOnRequest', 'light1'))
+        assert response['header']['name'] == 'TurnOnConfirmation'
+    assert seen == [{'active': True, 'sub': 'user1'}] * 2
+
+    for _ in range(2):
+        response = home.lambda_handler(discover_request)
+        assert response['header']['name'] == 'InvalidAccessTokenError'
+    assert calls == ['[OAuth token here]', 'OAuth Token']